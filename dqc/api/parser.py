@@ -53,7 +53,7 @@ def parse_moldesc(moldesc: Union[str, Tuple[AtomZsType, AtomPosType]],
         if not isinstance(atompos_raw, torch.Tensor):
             atompos = torch.as_tensor(atompos_raw, dtype=dtype, device=device)
         else:
-            atompos = atompos_raw.to(dtype).to(device)  # already a tensor
+            atompos = atompos_raw.to(dtype=dtype, device=device)  # already a tensor
 
     # convert to dtype if atomzs is a floating point tensor, not an integer tensor
     if atomzs.is_floating_point():
@@ -9,6 +9,18 @@ from dqc.utils.mem import get_memory
 from dqc.utils.config import config
 from dqc.utils.misc import logger
 
+# eigenvalues of j2c below this are dropped in its pseudo-inverse
+# (as the linear dependency threshold in pyscf's density fitting)
+J2C_EIG_THRESHOLD = 1e-9
+
+def _pinv_symm(mat: torch.Tensor) -> torch.Tensor:
+    # pseudo-inverse of a symmetric matrix, ignoring the eigen-directions with
+    # eigenvalues below J2C_EIG_THRESHOLD
+    eival, eivec = torch.linalg.eigh(mat)
+    mask = eival > J2C_EIG_THRESHOLD
+    eivec = eivec[:, mask]
+    return torch.matmul(eivec / eival[mask], eivec.transpose(-2, -1))
+
 class DFMol(BaseDF):
     """
     DFMol represents the class of density fitting for an isolated molecule.
@@ -45,14 +57,29 @@ class DFMol(BaseDF):
         self._j2c = j2c  # (nxao, nxao)
         self._j3c = j3c  # (nao, nao, nxao)
         logger.log("Precompute matrix for density fittings")
-        self._inv_j2c = torch.inverse(j2c)
+        # j2c is symmetric positive definite, so use its Cholesky factor
+        # instead of the explicit inverse, unless it is numerically not positive
+        # definite (e.g. with large, diffuse, or linearly dependent auxiliary
+        # basis), then use the pseudo-inverse from its eigendecomposition
+        j2c_chol, info = torch.linalg.cholesky_ex(j2c)  # (nxao, nxao)
+        pivots = torch.diagonal(j2c_chol, dim1=-2, dim2=-1)
+        self._j2c_is_pd = int(info) == 0 and bool(torch.all(pivots * pivots > J2C_EIG_THRESHOLD))
+        if self._j2c_is_pd:
+            self._j2c_chol = j2c_chol
+        else:
+            logger.log("The 2-centre auxiliary metric is not positive definite, using its pseudo-inverse")
+            self._j2c_inv = _pinv_symm(j2c)  # (nxao, nxao)
 
         # if the memory is too big, then don't precompute elmat
         if get_memory(j3c) > config.THRESHOLD_MEMORY:
             self._precompute_elmat = False
         else:
             self._precompute_elmat = True
-            self._el_mat = torch.matmul(j3c, self._inv_j2c)  # (nao, nao, nxao)
+            # el_mat = j3c @ j2c^-1, computed as (j2c^-1 @ j3c^T)^T
+            nxao = j3c.shape[-1]
+            j3c2 = j3c.reshape(-1, nxao).transpose(-2, -1)  # (nxao, nao * nao)
+            el_mat = self._solve_j2c(j3c2)  # (nxao, nao * nao)
+            self._el_mat = el_mat.transpose(-2, -1).reshape(j3c.shape)  # (nao, nao, nxao)
 
         logger.log("Density fitting done")
         return self
@@ -69,8 +96,8 @@ class DFMol(BaseDF):
         if self._precompute_elmat:
             df_coeffs = torch.einsum("...ij,ijk->...k", dm, self._el_mat)  # (*BD, nxao)
         else:
-            temp = torch.einsum("...ij,ijl->...l", dm, self._j3c)
-            df_coeffs = torch.einsum("...l,lk->...k", temp, self._inv_j2c)  # (*BD, nxao)
+            temp = torch.einsum("...ij,ijl->...l", dm, self._j3c)  # (*BD, nxao)
+            df_coeffs = self._solve_j2c(temp.unsqueeze(-1)).squeeze(-1)  # (*BD, nxao)
 
         mat = torch.einsum("...k,ijk->...ij", df_coeffs, self._j3c)  # (*BD, nao, nao)
         mat = (mat + mat.transpose(-2, -1)) * 0.5
@@ -78,6 +105,14 @@ class DFMol(BaseDF):
             mat = self._orthozer.convert2(mat)
         return xt.LinearOperator.m(mat, is_hermitian=True)
 
+    def _solve_j2c(self, b: torch.Tensor) -> torch.Tensor:
+        # returns j2c^-1 @ b
+        # b: (*BD, nxao, ncols)
+        if self._j2c_is_pd:
+            return torch.cholesky_solve(b, self._j2c_chol)
+        else:
+            return torch.matmul(self._j2c_inv, b)
+
     @property
     def j2c(self) -> torch.Tensor:
         return self._j2c
@@ -91,7 +126,8 @@ class DFMol(BaseDF):
             if self._precompute_elmat:
                 params = [prefix + "_el_mat", prefix + "_j3c"]
             else:
-                params = [prefix + "_inv_j2c", prefix + "_j3c"]
+                j2c_name = "_j2c_chol" if self._j2c_is_pd else "_j2c_inv"
+                params = [prefix + j2c_name, prefix + "_j3c"]
             if self._orthozer is not None:
                 pfix = prefix + "_orthozer."
                 params += self._orthozer.getparamnames("unconvert_dm", prefix=pfix) + \
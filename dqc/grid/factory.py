@@ -148,7 +148,8 @@ def get_grid(atomzs: Union[List[int], torch.Tensor], atompos: torch.Tensor,
     # convert the atomzs to a list of integers
     if isinstance(atomzs, torch.Tensor):
         assert atomzs.ndim == 1
-        atomzs_list = [a.item() for a in atomzs]
+        # a single tolist() instead of one .item() (and device sync) per atom
+        atomzs_list = atomzs.tolist()
     else:
         atomzs_list = list(atomzs)
 
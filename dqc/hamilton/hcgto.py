@@ -325,7 +325,9 @@ class HamiltonCGTO(BaseHamilton):
             lambda dm_: self._dm2densinfo(dm_), dm)  # (spin) value: (*BD, nr)
         edens = self.xc.get_edensityxc(densinfo)  # (*BD, nr)
 
-        return torch.sum(self.grid.get_dvolume() * edens, dim=-1)
+        # integrate over the grid as a matrix-vector product (no (*BD, nr) temporary),
+        # dvolume is cast because edens can be complex in pbc
+        return torch.matmul(edens, self.grid.get_dvolume().to(edens.dtype))
 
     ############### free parameters for variational method ###############
     @overload
@@ -1,10 +1,9 @@
-import re
 import ctypes
 from typing import Tuple, Optional
 import torch
 import numpy as np
 from dqc.hamilton.intor.lcintwrap import LibcintWrapper
-from dqc.hamilton.intor.utils import np2ctypes, int2ctypes, NDIM, CGTO
+from dqc.hamilton.intor.utils import np2ctypes, NDIM, CGTO
 from dqc.hamilton.intor.pbcintor import _get_default_kpts, _get_default_options, PBCIntOption
 from dqc.utils.pbc import estimate_ovlp_rcut
 from dqc.hamilton.intor.molintor import _gather_at_dims
@@ -13,12 +12,17 @@ __all__ = ["evl", "eval_gto", "eval_gradgto", "eval_laplgto",
            "pbc_evl", "pbc_eval_gto", "pbc_eval_gradgto", "pbc_eval_laplgto"]
 
 BLKSIZE = 128  # same as lib/gto/grid_ao_drv.c
+# libcgto drops the primitives with alpha * r^2 - log|coeff| above its
+# EXPCUTOFF (50 in lib/gto/grid_ao_drv.h), so a shell whose primitives are all
+# above it in a block of grid points is zero there and can be skipped
+SCREEN_EXPCUTOFF = 60.0
+# number of blocks whose distances to the atoms are computed at once
+_NON0TAB_NBLK = 64
 
 # evaluation of the gaussian basis
 def evl(shortname: str, wrapper: LibcintWrapper, rgrid: torch.Tensor,
         *, to_transpose: bool = False) -> torch.Tensor:
-    # expand ao_to_atom to have shape of (nao, ndim)
-    ao_to_atom = wrapper.ao_to_atom().unsqueeze(-1).expand(-1, NDIM)
+    ao_to_atom = wrapper.ao_to_atom()
 
     # rgrid: (ngrid, ndim)
     return _EvalGTO.apply(
@@ -111,7 +115,7 @@ class _EvalGTO(torch.autograd.Function):
                 rgrid: torch.Tensor,  # (ngrid, ndim)
 
                 # other non-tensor info
-                ao_to_atom: torch.Tensor,  # int tensor (nao, ndim)
+                ao_to_atom: torch.Tensor,  # int tensor (nao,)
                 wrapper: LibcintWrapper,
                 shortname: str,
                 to_transpose: bool) -> torch.Tensor:
@@ -187,7 +191,7 @@ class _EvalGTO(torch.autograd.Function):
                 grad_rao = torch.movedim(grad_r, -2, 0)  # (nao, ndim, *, ngrid)
                 grad_rao = -grad_rao.reshape(*grad_rao.shape[:2], -1).sum(dim=-1)  # (nao, ndim)
                 grad_pos = torch.zeros_like(pos)  # (natom, ndim)
-                grad_pos.scatter_add_(dim=0, index=ao_to_atom, src=grad_rao)
+                grad_pos.index_add_(0, ao_to_atom, grad_rao)
 
         return grad_coeffs, grad_alphas, grad_pos, grad_rgrid, \
             None, None, None, None, None, None
@@ -202,19 +206,17 @@ def gto_evaluator(wrapper: LibcintWrapper, shortname: str, rgrid: torch.Tensor,
     # returns: (*, nao, ngrid) if not to_transpose else (*, ngrid, nao)
 
     ngrid = rgrid.shape[0]
-    nshells = len(wrapper)
     nao = wrapper.nao()
     opname = _get_evalgto_opname(shortname, wrapper.spherical)
     outshape = _get_evalgto_compshape(shortname) + (nao, ngrid)
 
     out = np.empty(outshape, dtype=np.float64)
-    non0tab = np.ones(((ngrid + BLKSIZE - 1) // BLKSIZE, nshells),
-                      dtype=np.int8)
 
-    # TODO: check if we need to transpose it first?
-    rgrid = rgrid.contiguous()
-    coords = np.asarray(rgrid, dtype=np.float64, order='F')
-    ao_loc = np.asarray(wrapper.full_shell_to_aoloc, dtype=np.int32)
+    # libcgto reads the coordinates as (ndim, ngrid), which is the Fortran
+    # order of rgrid, so there is no copy if rgrid is a transposed view of
+    # a (ndim, ngrid) tensor, and only one copy otherwise
+    coords = np.ascontiguousarray(rgrid.detach().cpu().numpy().T, dtype=np.float64).T
+    non0tab = _make_non0tab(wrapper, coords)
 
     c_shls = (ctypes.c_int * 2)(*wrapper.shell_idxs)
     c_ngrid = ctypes.c_int(ngrid)
@@ -222,15 +224,12 @@ def gto_evaluator(wrapper: LibcintWrapper, shortname: str, rgrid: torch.Tensor,
     # evaluate the orbital
     operator = getattr(CGTO(), opname)
     operator.restype = ctypes.c_double
-    atm, bas, env = wrapper.atm_bas_env
     operator(c_ngrid, c_shls,
-             np2ctypes(ao_loc),
+             wrapper.full_shell_to_aoloc_ptr,
              np2ctypes(out),
              np2ctypes(coords),
              np2ctypes(non0tab),
-             np2ctypes(atm), int2ctypes(atm.shape[0]),
-             np2ctypes(bas), int2ctypes(bas.shape[0]),
-             np2ctypes(env))
+             *wrapper.atm_bas_env_ptrs)
 
     if to_transpose:
         out = np.ascontiguousarray(np.moveaxis(out, -1, -2))
@@ -238,6 +237,46 @@ def gto_evaluator(wrapper: LibcintWrapper, shortname: str, rgrid: torch.Tensor,
     out_tensor = torch.as_tensor(out, dtype=wrapper.dtype, device=wrapper.device)
     return out_tensor
 
+def _make_non0tab(wrapper: LibcintWrapper, coords: np.ndarray) -> np.ndarray:
+    # returns the mask of the shells that are non-zero (1) in each block of
+    # BLKSIZE grid points, shape: (nblocks, nshells_tot)
+    # libcgto indexes the mask with the shell index in the full bas, so it
+    # covers all the shells even if the wrapper is a subset
+    # coords: (ngrid, ndim)
+    ngrid = coords.shape[0]
+    nblocks = (ngrid + BLKSIZE - 1) // BLKSIZE
+    atm, bas, env = wrapper.atm_bas_env
+    if nblocks == 0:
+        return np.ones((nblocks, bas.shape[0]), dtype=np.int8)
+
+    # the minimum squared distance from every atom to the points in every
+    # block, computed a few blocks at a time so only a
+    # (_NON0TAB_NBLK * BLKSIZE, natoms) distance matrix is alive at once
+    atompos = env[atm[:, 1, None] + np.arange(NDIM)]  # (natoms, ndim)
+    atomsq = np.einsum("ad,ad->a", atompos, atompos)  # (natoms,)
+    natoms = atompos.shape[0]
+    minrr = np.empty((nblocks, natoms))  # (nblocks, natoms)
+    for ib0 in range(0, nblocks, _NON0TAB_NBLK):
+        ib1 = min(ib0 + _NON0TAB_NBLK, nblocks)
+        c = coords[ib0 * BLKSIZE:ib1 * BLKSIZE]
+        rr = np.einsum("gd,gd->g", c, c)[:, None] - 2 * c @ atompos.T + atomsq  # (ng, natoms)
+        # the last block might be partial, reduce it separately
+        nfull = rr.shape[0] // BLKSIZE
+        if nfull > 0:
+            minrr[ib0:ib0 + nfull] = rr[:nfull * BLKSIZE].reshape(nfull, BLKSIZE, natoms).min(axis=1)
+        if ib0 + nfull < ib1:
+            minrr[ib1 - 1] = rr[nfull * BLKSIZE:].min(axis=0)
+
+    # the smallest exponent argument of the primitives of every shell
+    gaussloc = wrapper.full_shell_to_gaussloc[:-1]  # (nshells_tot,)
+    gauss_to_shell = np.repeat(np.arange(bas.shape[0]), np.diff(wrapper.full_shell_to_gaussloc))
+    igauss = np.arange(len(gauss_to_shell)) - gaussloc[gauss_to_shell]
+    alphas = env[bas[gauss_to_shell, 5] + igauss]  # (ngauss_tot,)
+    logc = np.log(np.abs(env[bas[gauss_to_shell, 6] + igauss]) + 1e-300)
+    arr = alphas * minrr[:, wrapper.full_shell_to_atom[gauss_to_shell]] - logc  # (nblocks, ngauss_tot)
+    minarr = np.minimum.reduceat(arr, gaussloc, axis=1)  # (nblocks, nshells_tot)
+    return (minarr < SCREEN_EXPCUTOFF).astype(np.int8)
+
 def _get_evalgto_opname(shortname: str, spherical: bool) -> str:
     # returns the complete name of the evalgto operation
     sname = ("_" + shortname) if (shortname != "") else ""
@@ -248,7 +287,9 @@ def _get_evalgto_compshape(shortname: str) -> Tuple[int, ...]:
     # returns the component shape of the evalgto function
 
     # count "ip" only at the beginning
-    n_ip = len(re.findall(r"^(?:ip)*(?:ip)?", shortname)[0]) // 2
+    n_ip = 0
+    while shortname.startswith("ip", 2 * n_ip):
+        n_ip += 1
     return (NDIM, ) * n_ip
 
 def _get_evalgto_derivname(shortname: str, derivmode: str):
@@ -116,8 +116,6 @@ def gto_ft_evaluator(wrapper: LibcintWrapper, gvgrid: torch.Tensor) -> torch.Ten
         [ghost_atom_basis], spherical=wrapper.spherical, lattice=wrapper.lattice)
     wrapper, ghost_wrapper = LibcintWrapper.concatenate(wrapper, ghost_wrapper)
     shls_slice = (*wrapper.shell_idxs, *ghost_wrapper.shell_idxs)
-    ao_loc = wrapper.full_shell_to_aoloc
-    atm, bas, env = wrapper.atm_bas_env
 
     # prepare the gvgrid
     GvT = np.asarray(gvgrid.detach().numpy().T, order="C")
@@ -129,13 +127,11 @@ def gto_ft_evaluator(wrapper: LibcintWrapper, gvgrid: torch.Tensor) -> torch.Ten
 
     fn(intor, eval_gz, fill, np2ctypes(out),
        int2ctypes(1), (ctypes.c_int * len(shls_slice))(*shls_slice),
-       np2ctypes(ao_loc),
+       wrapper.full_shell_to_aoloc_ptr,
        ctypes.c_double(0),
        np2ctypes(GvT),
        p_b, p_gxyzT, p_gs,
        int2ctypes(nGv),
-       np2ctypes(atm), int2ctypes(len(atm)),
-       np2ctypes(bas), int2ctypes(len(bas)),
-       np2ctypes(env))
+       *wrapper.atm_bas_env_ptrs)
 
     return torch.as_tensor(out, dtype=get_complex_dtype(dtype), device=device)
@@ -91,8 +91,10 @@ class Lattice(object):
         gvgrids = self._generate_lattice_vectors(b, gcut, exclude_zeros=exclude_zeros)
 
         # 1 / cell.vol == det(b) / (2 pi)^3
-        weights = torch.zeros(gvgrids.shape[0], dtype=self.dtype, device=self.device)
-        weights = weights + torch.abs(torch.det(b)) / (2 * np.pi) ** 3
+        # all the G-points have the same weight, so just broadcast it (zero-stride)
+        # instead of materializing the (ng,) tensor
+        weight = torch.abs(torch.det(b)) / (2 * np.pi) ** 3
+        weights = weight.expand(gvgrids.shape[0])
         return gvgrids, weights
 
     def estimate_ewald_eta(self, precision: float) -> float:
@@ -1,11 +1,11 @@
 from __future__ import annotations
-from contextlib import contextmanager
-from typing import List, Tuple, Iterator, Optional, Dict
+import ctypes
+from typing import List, Tuple, Optional, Dict
 import copy
 import torch
 import numpy as np
 from dqc.utils.datastruct import AtomCGTOBasis, CGTOBasis
-from dqc.hamilton.intor.utils import np2ctypes, int2ctypes, NDIM, CINT
+from dqc.hamilton.intor.utils import np2ctypes, int2ctypes, NDIM
 from dqc.hamilton.intor.lattice import Lattice
 from dqc.utils.misc import memoize_method
 
@@ -34,29 +34,27 @@ class LibcintWrapper(object):
         self.device = atombases[0].bases[0].alphas.device
 
         # construct _atm, _bas, and _env as well as the parameters
+        # (the triplets are allocated directly as contiguous arrays with the
+        # sizes expected by libcint and filled in place)
+        nshells = sum(len(atombasis.bases) for atombasis in atombases)
+        ngauss_tot = sum(len(shell.alphas) for atombasis in atombases for shell in atombasis.bases)
         ptr_env = 20  # initial padding from libcint
-        atm_list: List[List[int]] = []
-        env_list: List[float] = [0.0] * ptr_env
-        bas_list: List[List[int]] = []
+        atm = np.zeros((self._natoms, 6), dtype=np.int32, order="C")
+        env = np.zeros(ptr_env + (NDIM + 1) * self._natoms + 2 * ngauss_tot, dtype=np.float64)
+        bas = np.zeros((nshells, 8), dtype=np.int32, order="C")
         allpos: List[torch.Tensor] = []
         allalphas: List[torch.Tensor] = []
         allcoeffs: List[torch.Tensor] = []
-        allangmoms: List[int] = []
-        shell_to_atom: List[int] = []
-        ngauss_at_shell: List[int] = []
-        gauss_to_shell: List[int] = []
 
-        # constructing the triplet lists and also collecting the parameters
-        nshells = 0
+        # constructing the triplet arrays and also collecting the parameters
         ishell = 0
         for iatom, atombasis in enumerate(atombases):
             # construct the atom environment
             assert atombasis.pos.numel() == NDIM, "Please report this bug in Github"
             atomz = atombasis.atomz
             #                charge    ptr_coord, nucl model (unused for standard nucl model)
-            atm_list.append([int(atomz), ptr_env, 1, ptr_env + NDIM, 0, 0])
-            env_list.extend(atombasis.pos.detach())
-            env_list.append(0.0)
+            atm[iatom] = (int(atomz), ptr_env, 1, ptr_env + NDIM, 0, 0)
+            env[ptr_env: ptr_env + NDIM] = _tensor2env(atombasis.pos)
             ptr_env += NDIM + 1
 
             # check if the atomz is fractional
@@ -68,9 +66,6 @@ class LibcintWrapper(object):
             # TODO: consider moving allpos into shell
             allpos.append(atombasis.pos.unsqueeze(0))
 
-            nshells += len(atombasis.bases)
-            shell_to_atom.extend([iatom] * len(atombasis.bases))
-
             # then construct the basis
             for shell in atombasis.bases:
                 assert shell.alphas.shape == shell.coeffs.shape and shell.alphas.ndim == 1,\
@@ -78,49 +73,68 @@ class LibcintWrapper(object):
                 shell.wfnormalize_()
                 ngauss = len(shell.alphas)
                 #                iatom, angmom,       ngauss, ncontr, kappa, ptr_exp
-                bas_list.append([iatom, shell.angmom, ngauss, 1, 0, ptr_env,
-                                 # ptr_coeffs,           unused
-                                 ptr_env + ngauss, 0])
-                env_list.extend(shell.alphas.detach())
-                env_list.extend(shell.coeffs.detach())
+                bas[ishell] = (iatom, shell.angmom, ngauss, 1, 0, ptr_env,
+                               # ptr_coeffs,           unused
+                               ptr_env + ngauss, 0)
+                env[ptr_env: ptr_env + ngauss] = _tensor2env(shell.alphas)
+                env[ptr_env + ngauss: ptr_env + 2 * ngauss] = _tensor2env(shell.coeffs)
                 ptr_env += 2 * ngauss
 
                 # add the alphas and coeffs to the parameters list
                 allalphas.append(shell.alphas)
                 allcoeffs.append(shell.coeffs)
-                allangmoms.extend([shell.angmom] * ngauss)
-                ngauss_at_shell.append(ngauss)
-                gauss_to_shell.extend([ishell] * ngauss)
                 ishell += 1
 
         # compile the parameters of this object
         self._allpos_params = torch.cat(allpos, dim=0)  # (natom, NDIM)
         self._allalphas_params = torch.cat(allalphas, dim=0)  # (ntot_gauss)
         self._allcoeffs_params = torch.cat(allcoeffs, dim=0)  # (ntot_gauss)
-        self._allangmoms = torch.tensor(allangmoms, dtype=torch.int32, device=self.device)  # (ntot_gauss)
-        self._gauss_to_shell = torch.tensor(gauss_to_shell, dtype=torch.int32, device=self.device)
 
-        # convert the lists to numpy to make it contiguous (Python lists are not contiguous)
-        self._atm = np.array(atm_list, dtype=np.int32, order="C")
-        self._bas = np.array(bas_list, dtype=np.int32, order="C")
-        self._env = np.array(env_list, dtype=np.float64, order="C")
+        self._setup_triplets(atm, bas, env)
+
+    def _setup_triplets(self, atm: np.ndarray, bas: np.ndarray, env: np.ndarray) -> None:
+        # set the triplet arrays and construct all the mappings derived from them
+        self._atm = atm
+        self._bas = bas
+        self._env = env
+        # ctypes pointers and sizes of the triplets, ready to be passed to libcint
+        self._atm_bas_env_ptrs = (
+            np2ctypes(self._atm), int2ctypes(self._atm.shape[0]),
+            np2ctypes(self._bas), int2ctypes(self._bas.shape[0]),
+            np2ctypes(self._env))
+        # libcint optimizers of the triplets, filled by the integrator
+        self._optimizer_cache: Dict[str, ctypes.c_void_p] = {}
+
+        nshells = bas.shape[0]
+        shell_to_atom = bas[:, 0].astype(np.int64)  # (nshells,)
+        angmoms = bas[:, 1]  # (nshells,)
+        ngauss_at_shell = bas[:, 2].astype(np.int64)  # (nshells,)
+        self._allangmoms = _np2index(np.repeat(angmoms, ngauss_at_shell), self.device,
+                                     dtype=torch.int32)  # (ntot_gauss)
+        self._gauss_to_shell = _np2index(np.repeat(np.arange(nshells, dtype=np.int32), ngauss_at_shell),
+                                         self.device, dtype=torch.int32)  # (ntot_gauss)
 
         # construct the full shell mapping
-        shell_to_aoloc = [0]
-        ao_to_shell: List[int] = []
-        ao_to_atom: List[int] = []
-        for i in range(nshells):
-            nao_at_shell_i = self._nao_at_shell(i)
-            shell_to_aoloc_i = shell_to_aoloc[-1] + nao_at_shell_i
-            shell_to_aoloc.append(shell_to_aoloc_i)
-            ao_to_shell.extend([i] * nao_at_shell_i)
-            ao_to_atom.extend([shell_to_atom[i]] * nao_at_shell_i)
-
-        self._ngauss_at_shell_list = ngauss_at_shell
-        self._shell_to_aoloc = np.array(shell_to_aoloc, dtype=np.int32)
+        # (the number of aos per shell is the same as CINTcgto_spheric/cart)
+        if self._spherical:
+            nao_at_shell = 2 * angmoms + 1
+        else:
+            nao_at_shell = (angmoms + 1) * (angmoms + 2) // 2
+        shell_to_aoloc = np.zeros(nshells + 1, dtype=np.int32)
+        np.cumsum(nao_at_shell, out=shell_to_aoloc[1:])
+        ao_to_shell = np.repeat(np.arange(nshells), nao_at_shell)
+        ao_to_atom = np.repeat(shell_to_atom, nao_at_shell)
+
+        self._ngauss_at_shell_list: List[int] = ngauss_at_shell.tolist()
+        self._shell_to_gaussloc = np.zeros(nshells + 1, dtype=np.int64)
+        np.cumsum(ngauss_at_shell, out=self._shell_to_gaussloc[1:])
+        self._shell_to_aoloc = shell_to_aoloc
+        self._shell_to_aoloc_ptr = np2ctypes(shell_to_aoloc)
+        self._shell_to_atom = shell_to_atom
         self._shell_idxs = (0, nshells)
-        self._ao_to_shell = torch.tensor(ao_to_shell, dtype=torch.long, device=self.device)
-        self._ao_to_atom = torch.tensor(ao_to_atom, dtype=torch.long, device=self.device)
+        self._ao_to_shell = _np2index(ao_to_shell, self.device)
+        self._ao_to_atom = _np2index(ao_to_atom, self.device)
+        self._setup_idxs()
 
     @property
     def parent(self) -> LibcintWrapper:
@@ -158,6 +172,20 @@ class LibcintWrapper(object):
         # this shouldn't change in the sliced wrapper
         return self._atm, self._bas, self._env
 
+    @property
+    def atm_bas_env_ptrs(self) -> Tuple[ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                        ctypes.c_int, ctypes.c_void_p]:
+        # returns the arguments for libcint functions from the triplet lists,
+        # i.e. (atm, natm, bas, nbas, env) as ctypes objects
+        # this shouldn't change in the sliced wrapper
+        return self._atm_bas_env_ptrs
+
+    @property
+    def optimizer_cache(self) -> Dict[str, ctypes.c_void_p]:
+        # returns the cache of the libcint optimizers built for the triplets
+        # this shouldn't change in the sliced wrapper
+        return self._optimizer_cache
+
     @property
     def full_angmoms(self) -> torch.Tensor:
         return self._allangmoms
@@ -182,6 +210,27 @@ class LibcintWrapper(object):
         # if this object is a subset, then returns the complete mapping
         return self._shell_to_aoloc
 
+    @property
+    def full_shell_to_aoloc_ptr(self) -> ctypes.c_void_p:
+        # returns the ctypes pointer of full_shell_to_aoloc to be passed to
+        # libcint/libcgto functions
+        return self._shell_to_aoloc_ptr
+
+    @property
+    def full_shell_to_atom(self) -> np.ndarray:
+        # returns the full array mapping from shell index to the atom index,
+        # i.e. a contiguous copy of the atom column of bas
+        # if this object is a subset, then returns the complete mapping
+        return self._shell_to_atom
+
+    @property
+    def full_shell_to_gaussloc(self) -> np.ndarray:
+        # returns the full array mapping from shell index to absolute gaussian
+        # location, i.e. the gaussians of i-th shell are
+        # (self.full_shell_to_gaussloc[i], self.full_shell_to_gaussloc[i + 1])
+        # if this object is a subset, then returns the complete mapping
+        return self._shell_to_gaussloc
+
     @property
     def full_gauss_to_shell(self) -> torch.Tensor:
         # returns the full index mapping from gaussian to shell tensor
@@ -205,39 +254,30 @@ class LibcintWrapper(object):
         # returns the number of gaussian basis at the given shell
         return self._ngauss_at_shell_list
 
-    @memoize_method
     def __len__(self) -> int:
         # total shells
-        return self.shell_idxs[-1] - self.shell_idxs[0]
+        return self._len
 
-    @memoize_method
     def nao(self) -> int:
         # returns the number of atomic orbitals
-        shell_idxs = self.shell_idxs
-        return self.full_shell_to_aoloc[shell_idxs[-1]] - \
-            self.full_shell_to_aoloc[shell_idxs[0]]
+        return self._nao
 
-    @memoize_method
     def ao_idxs(self) -> Tuple[int, int]:
         # returns the lower and upper indices of the atomic orbitals of this object
         # in the full ao map (i.e. absolute indices)
-        shell_idxs = self.shell_idxs
-        return self.full_shell_to_aoloc[shell_idxs[0]], \
-            self.full_shell_to_aoloc[shell_idxs[1]]
+        return self._ao_idxs
 
-    @memoize_method
     def ao_to_atom(self) -> torch.Tensor:
         # get the relative mapping from atomic orbital relative index to the
         # absolute atom position
         # this is usually used in scatter in backward calculation
-        return self.full_ao_to_atom[slice(*self.ao_idxs())]
+        return self._rel_ao_to_atom
 
-    @memoize_method
     def ao_to_shell(self) -> torch.Tensor:
         # get the relative mapping from atomic orbital relative index to the
         # absolute shell position
         # this is usually used in scatter in backward calculation
-        return self.full_ao_to_shell[slice(*self.ao_idxs())]
+        return self._rel_ao_to_shell
 
     def __getitem__(self, inp) -> LibcintWrapper:
         # get the subset of the shells, but keeping the environment and
@@ -276,23 +316,18 @@ class LibcintWrapper(object):
                 alphas = shell.alphas
                 coeffs = shell.coeffs
                 normalized = shell.normalized
+                # unbind the (ngauss, 1) views at once, to get (1,)-shaped views
+                # without indexing every gaussian separately
                 new_bases.extend([
-                    CGTOBasis(angmom, alpha[None], coeff[None], normalized=normalized)
-                    for (alpha, coeff) in zip(alphas, coeffs)
+                    CGTOBasis(angmom, alpha, coeff, normalized=normalized)
+                    for (alpha, coeff) in zip(alphas.unsqueeze(-1).unbind(0),
+                                              coeffs.unsqueeze(-1).unbind(0))
                 ])
             new_atombases.append(AtomCGTOBasis(atomz=atomz, bases=new_bases, pos=pos))
-        uncontr_wrapper = LibcintWrapper(
-            new_atombases, spherical=self.spherical)
+        uncontr_wrapper = self._uncontract_triplets(new_atombases)
 
         # get the mapping uncontracted ao to the contracted ao
-        uao2ao: List[int] = []
-        idx_ao = 0
-        # iterate over shells
-        for i in range(len(self)):
-            nao = self._nao_at_shell(i)
-            uao2ao += list(range(idx_ao, idx_ao + nao)) * self.ngauss_at_shell[i]
-            idx_ao += nao
-        uao2ao_res = torch.tensor(uao2ao, dtype=torch.long, device=self.device)
+        uao2ao_res = self._get_uao2ao()
         return uncontr_wrapper, uao2ao_res
 
     @staticmethod
@@ -361,26 +396,67 @@ class LibcintWrapper(object):
         return (*res,)
 
     ############### misc functions ###############
-    @contextmanager
-    def centre_on_r(self, r: torch.Tensor) -> Iterator:
-        # set the centre of coordinate to r (usually used in rinv integral)
-        # r: (ndim,)
-        try:
-            env = self.atm_bas_env[-1]
-            prev_centre = env[PTR_RINV_ORIG: PTR_RINV_ORIG + NDIM]
-            env[PTR_RINV_ORIG: PTR_RINV_ORIG + NDIM] = r.detach().numpy()
-            yield
-        finally:
-            env[PTR_RINV_ORIG: PTR_RINV_ORIG + NDIM] = prev_centre
+    def _setup_idxs(self) -> None:
+        # precompute the sizes and the relative index mappings of this object
+        # (these are accessed very often, so they are stored as attributes)
+        shell_idxs = self.shell_idxs
+        aoloc = self.full_shell_to_aoloc
+        self._len = shell_idxs[1] - shell_idxs[0]
+        self._ao_idxs = (int(aoloc[shell_idxs[0]]), int(aoloc[shell_idxs[1]]))
+        self._nao = self._ao_idxs[1] - self._ao_idxs[0]
+        self._rel_ao_to_atom = self.full_ao_to_atom[slice(*self._ao_idxs)]
+        self._rel_ao_to_shell = self.full_ao_to_shell[slice(*self._ao_idxs)]
+
+    def _uncontract_triplets(self, new_atombases: List[AtomCGTOBasis]) -> LibcintWrapper:
+        # construct the uncontracted wrapper directly from the triplet arrays of
+        # this object (the normalized alphas and coeffs are already in env, so
+        # each gaussian only needs its own row in bas pointing to them)
+        uwrapper = LibcintWrapper.__new__(LibcintWrapper)
+        uwrapper._atombases = new_atombases
+        uwrapper._spherical = self._spherical
+        uwrapper._fracz = self._fracz
+        uwrapper._natoms = self._natoms
+        uwrapper._lattice = None
+        uwrapper.dtype = self.dtype
+        uwrapper.device = self.device
+        uwrapper._allpos_params = self._allpos_params
+        uwrapper._allalphas_params = self._allalphas_params
+        uwrapper._allcoeffs_params = self._allcoeffs_params
+
+        ngauss_at_shell = self._bas[:, 2]
+        gauss_to_shell = np.repeat(np.arange(self._bas.shape[0]), ngauss_at_shell)
+        idx_in_shell = np.arange(len(gauss_to_shell)) - self._shell_to_gaussloc[gauss_to_shell]
+        ubas = self._bas[gauss_to_shell]  # (ntot_gauss, 8)
+        ubas[:, 2] = 1  # ngauss
+        ubas[:, 5] += idx_in_shell.astype(np.int32)  # ptr_exp
+        ubas[:, 6] += idx_in_shell.astype(np.int32)  # ptr_coeffs
+        uwrapper._setup_triplets(self._atm.copy(), ubas, self._env.copy())
+        return uwrapper
+
+    def _get_uao2ao(self) -> torch.Tensor:
+        # returns the mapping from the uncontracted ao to the contracted ao
+        # (both relative index), i.e. the ao indices of every shell in this
+        # object, repeated by the number of gaussians in the shell
+        sh0, sh1 = self.shell_idxs
+        nao_at_shell = np.diff(self.full_shell_to_aoloc[sh0: sh1 + 1]).astype(np.int64)
+        ngauss_at_shell = np.diff(self.full_shell_to_gaussloc[sh0: sh1 + 1])
+        aoloc = np.cumsum(nao_at_shell) - nao_at_shell  # (nshells,)
+
+        # the same information for every uncontracted shell
+        u_nao = np.repeat(nao_at_shell, ngauss_at_shell)
+        u_aoloc = np.repeat(aoloc, ngauss_at_shell)
+
+        # index of the ao within its own shell
+        u_uaoloc = np.cumsum(u_nao) - u_nao
+        idx_in_shell = np.arange(np.sum(u_nao)) - np.repeat(u_uaoloc, u_nao)
+        uao2ao = np.repeat(u_aoloc, u_nao) + idx_in_shell
+        return _np2index(uao2ao, self.device)
 
     def _nao_at_shell(self, sh: int) -> int:
         # returns the number of atomic orbital at the given shell index
-        if self.spherical:
-            op = CINT().CINTcgto_spheric
-        else:
-            op = CINT().CINTcgto_cart
-        bas = self.atm_bas_env[1]
-        return op(int2ctypes(sh), np2ctypes(bas))
+        # (read from the shell-to-ao map instead of calling libcint)
+        aoloc = self.full_shell_to_aoloc
+        return int(aoloc[sh + 1] - aoloc[sh])
 
 class SubsetLibcintWrapper(LibcintWrapper):
     """
@@ -393,6 +469,26 @@ class SubsetLibcintWrapper(LibcintWrapper):
         self._parent = parent
         self._shell_idxs = subset.start, subset.stop
 
+        # bind the parent's frequently accessed attributes directly to skip
+        # the __getattr__ fallback (the other attributes still use it)
+        self.dtype = parent.dtype
+        self.device = parent.device
+        self._spherical = parent._spherical
+        self._lattice = parent._lattice
+        self._atm = parent._atm
+        self._bas = parent._bas
+        self._env = parent._env
+        self._atm_bas_env_ptrs = parent._atm_bas_env_ptrs
+        self._optimizer_cache = parent._optimizer_cache
+        self._allcoeffs_params = parent._allcoeffs_params
+        self._allalphas_params = parent._allalphas_params
+        self._allpos_params = parent._allpos_params
+        self._shell_to_aoloc = parent._shell_to_aoloc
+        self._shell_to_aoloc_ptr = parent._shell_to_aoloc_ptr
+        self._ao_to_shell = parent._ao_to_shell
+        self._ao_to_atom = parent._ao_to_atom
+        self._setup_idxs()
+
     @property
     def parent(self) -> LibcintWrapper:
         return self._parent
@@ -411,19 +507,13 @@ class SubsetLibcintWrapper(LibcintWrapper):
 
         # determine the corresponding shell indices in the new uncontracted wrapper
         shell_idxs = self.shell_idxs
-        gauss_idx0 = sum(self._parent.ngauss_at_shell[: shell_idxs[0]])
-        gauss_idx1 = sum(self._parent.ngauss_at_shell[: shell_idxs[1]])
+        gauss_idx0 = int(self._parent.full_shell_to_gaussloc[shell_idxs[0]])
+        gauss_idx1 = int(self._parent.full_shell_to_gaussloc[shell_idxs[1]])
         u_wrapper = pu_wrapper[gauss_idx0: gauss_idx1]
 
         # construct the uao (relative index) mapping to the absolute index
         # of the atomic orbital in the contracted basis
-        uao2ao = []
-        idx_ao = 0
-        for i in range(shell_idxs[0], shell_idxs[1]):
-            nao = self._parent._nao_at_shell(i)
-            uao2ao += list(range(idx_ao, idx_ao + nao)) * self._parent.ngauss_at_shell[i]
-            idx_ao += nao
-        uao2ao_res = torch.tensor(uao2ao, dtype=torch.long, device=self.device)
+        uao2ao_res = self._get_uao2ao()
         return u_wrapper, uao2ao_res
 
     def __getitem__(self, inp):
@@ -431,3 +521,13 @@ class SubsetLibcintWrapper(LibcintWrapper):
 
     def __getattr__(self, name):
         return getattr(self._parent, name)
+
+def _tensor2env(a: torch.Tensor) -> np.ndarray:
+    # convert the tensor into a flat float64 numpy array to be put in _env
+    # (avoiding iterating the tensor element by element in Python)
+    return a.detach().cpu().numpy().astype(np.float64, copy=False).reshape(-1)
+
+def _np2index(a: np.ndarray, device: torch.device, dtype: torch.dtype = torch.long) -> torch.Tensor:
+    # convert the numpy integer array into an index tensor, sharing the memory
+    # with the numpy array if it is already in the right type on cpu
+    return torch.from_numpy(a).to(dtype=dtype, device=device)
@@ -5,9 +5,11 @@ import operator
 from functools import reduce
 import numpy as np
 import torch
-from dqc.hamilton.intor.lcintwrap import LibcintWrapper
+from dqc.hamilton.intor.lcintwrap import LibcintWrapper, PTR_RINV_ORIG
 from dqc.hamilton.intor.utils import np2ctypes, int2ctypes, NDIM, CINT, CGTO
 from dqc.hamilton.intor.namemgr import IntorNameManager
+from dqc.utils.config import config
+from dqc.utils.misc import thread_map
 
 __all__ = ["int1e", "int3c2e", "int2e",
            "overlap", "kinetic", "nuclattr", "elrep", "coul2c", "coul3c"]
@@ -103,12 +105,14 @@ def nuclattr(wrapper: LibcintWrapper, other: Optional[LibcintWrapper] = None) ->
     if not wrapper.fracz:
         return int1e("nuc", wrapper, other=other)
     else:
-        res = torch.tensor([])
         allpos_params = wrapper.params[-1]
-        for i in range(wrapper.natoms):
-            y = int1e("rinv", wrapper, other=other, rinv_pos=allpos_params[i]) * \
-                (-wrapper.atombases[i].atomz)
-            res = y if (i == 0) else (res + y)
+        ys = thread_map(
+            lambda i: int1e("rinv", wrapper, other=other, rinv_pos=allpos_params[i]) *
+            (-wrapper.atombases[i].atomz),
+            range(wrapper.natoms))
+        res = ys[0]
+        for y in ys[1:]:
+            res = res + y
         return res
 
 def elrep(wrapper: LibcintWrapper,
@@ -167,8 +171,7 @@ class _Int2cFunction(torch.autograd.Function):
 
         if int_nmgr.rawopname == "rinv":
             assert rinv_pos.ndim == 1 and rinv_pos.shape[0] == NDIM
-            with wrappers[0].centre_on_r(rinv_pos):
-                out_tensor = Intor(int_nmgr, wrappers).calc()
+            out_tensor = Intor(int_nmgr, wrappers, rinv_pos=rinv_pos).calc()
         else:
             out_tensor = Intor(int_nmgr, wrappers).calc()
         ctx.save_for_backward(allcoeffs, allalphas, allposs, rinv_pos)
@@ -207,12 +210,11 @@ class _Int2cFunction(torch.autograd.Function):
 
             # grad_allpossT is only a view of grad_allposs, so the operation below
             # also changes grad_allposs
-            ao_to_atom0 = wrappers[0].ao_to_atom().expand(ndim, -1)
-            ao_to_atom1 = wrappers[1].ao_to_atom().expand(ndim, -1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom0, src=grad_dpos_i)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom1, src=grad_dpos_j)
+            ao_to_atom0 = wrappers[0].ao_to_atom()
+            ao_to_atom1 = wrappers[1].ao_to_atom()
+            grad_allpossT.index_add_(-1, ao_to_atom0, grad_dpos_i)
+            grad_allpossT.index_add_(-1, ao_to_atom1, grad_dpos_j)
 
-            grad_allposs_nuc = torch.zeros_like(grad_allposs)
             if "nuc" == int_nmgr.rawopname:
                 # allposs: (natoms, ndim)
                 natoms = allposs.shape[0]
@@ -221,7 +223,7 @@ class _Int2cFunction(torch.autograd.Function):
                 sname_derivs = [int_nmgr_rinv.get_intgl_deriv_namemgr("ip", ib) for ib in (0, 1)]
                 new_axes_pos = [int_nmgr_rinv.get_intgl_deriv_newaxispos("ip", ib) for ib in (0, 1)]
 
-                for i in range(natoms):
+                def _grad_atpos(i: int) -> torch.Tensor:
                     atomz = wrappers[0].atombases[i].atomz
 
                     # get the integrals
@@ -233,8 +235,11 @@ class _Int2cFunction(torch.autograd.Function):
 
                     grad_datpos = grad_out * (dout_datposs[0] + dout_datposs[1])
                     grad_datpos = grad_datpos.reshape(grad_datpos.shape[0], -1).sum(dim=-1)
-                    grad_allposs_nuc[i] = (-atomz) * grad_datpos
+                    return (-atomz) * grad_datpos
 
+                # the rinv integrals of different atoms are independent, so
+                # they are calculated in parallel
+                grad_allposs_nuc = torch.stack(thread_map(_grad_atpos, range(natoms)), dim=0)
                 grad_allposs += grad_allposs_nuc
 
         # gradient for the rinv_pos in rinv integral
@@ -366,12 +371,12 @@ class _Int3cFunction(torch.autograd.Function):
             grad_pos_a2 = -torch.einsum("dzijk,zijk->dj", dout_dposs[1].reshape(*shape), grad_out2)
             grad_pos_b1 = -torch.einsum("dzijk,zijk->dk", dout_dposs[2].reshape(*shape), grad_out2)
 
-            ao_to_atom0 = wrappers[0].ao_to_atom().expand(ndim, -1)
-            ao_to_atom1 = wrappers[1].ao_to_atom().expand(ndim, -1)
-            ao_to_atom2 = wrappers[2].ao_to_atom().expand(ndim, -1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom0, src=grad_pos_a1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom1, src=grad_pos_a2)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom2, src=grad_pos_b1)
+            ao_to_atom0 = wrappers[0].ao_to_atom()
+            ao_to_atom1 = wrappers[1].ao_to_atom()
+            ao_to_atom2 = wrappers[2].ao_to_atom()
+            grad_allpossT.index_add_(-1, ao_to_atom0, grad_pos_a1)
+            grad_allpossT.index_add_(-1, ao_to_atom1, grad_pos_a2)
+            grad_allpossT.index_add_(-1, ao_to_atom2, grad_pos_b1)
 
         # gradients for the basis coefficients
         grad_allcoeffs: Optional[torch.Tensor] = None
@@ -484,19 +489,19 @@ class _Int4cFunction(torch.autograd.Function):
             ndim = dout_dposs[0].shape[0]
             shape = (ndim, -1, *naos)
             grad_out2 = grad_out.reshape(*shape[1:])
-            grad_pos_a1 = -torch.einsum("dzijkl,zijkl->di", dout_dposs[0].reshape(*shape), grad_out2)
-            grad_pos_a2 = -torch.einsum("dzijkl,zijkl->dj", dout_dposs[1].reshape(*shape), grad_out2)
-            grad_pos_b1 = -torch.einsum("dzijkl,zijkl->dk", dout_dposs[2].reshape(*shape), grad_out2)
-            grad_pos_b2 = -torch.einsum("dzijkl,zijkl->dl", dout_dposs[3].reshape(*shape), grad_out2)
-
-            ao_to_atom0 = wrappers[0].ao_to_atom().expand(ndim, -1)
-            ao_to_atom1 = wrappers[1].ao_to_atom().expand(ndim, -1)
-            ao_to_atom2 = wrappers[2].ao_to_atom().expand(ndim, -1)
-            ao_to_atom3 = wrappers[3].ao_to_atom().expand(ndim, -1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom0, src=grad_pos_a1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom1, src=grad_pos_a2)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom2, src=grad_pos_b1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom3, src=grad_pos_b2)
+            grad_pos_a1 = -_contract_at_dim(dout_dposs[0].reshape(*shape), grad_out2, -4)
+            grad_pos_a2 = -_contract_at_dim(dout_dposs[1].reshape(*shape), grad_out2, -3)
+            grad_pos_b1 = -_contract_at_dim(dout_dposs[2].reshape(*shape), grad_out2, -2)
+            grad_pos_b2 = -_contract_at_dim(dout_dposs[3].reshape(*shape), grad_out2, -1)
+
+            ao_to_atom0 = wrappers[0].ao_to_atom()
+            ao_to_atom1 = wrappers[1].ao_to_atom()
+            ao_to_atom2 = wrappers[2].ao_to_atom()
+            ao_to_atom3 = wrappers[3].ao_to_atom()
+            grad_allpossT.index_add_(-1, ao_to_atom0, grad_pos_a1)
+            grad_allpossT.index_add_(-1, ao_to_atom1, grad_pos_a2)
+            grad_allpossT.index_add_(-1, ao_to_atom2, grad_pos_b1)
+            grad_allpossT.index_add_(-1, ao_to_atom3, grad_pos_b2)
 
         # gradients for the basis coefficients
         grad_allcoeffs: Optional[torch.Tensor] = None
@@ -538,10 +543,10 @@ class _Int4cFunction(torch.autograd.Function):
 
                 # reduce the uncontracted integrations
                 # grad_coeff_*: (nu_ao*)
-                grad_coeff_a1 = torch.einsum("...ijkl,...ijkl->i", dout_dcoeff_a1, u_grad_out)
-                grad_coeff_a2 = torch.einsum("...ijkl,...ijkl->j", dout_dcoeff_a2, u_grad_out)
-                grad_coeff_b1 = torch.einsum("...ijkl,...ijkl->k", dout_dcoeff_b1, u_grad_out)
-                grad_coeff_b2 = torch.einsum("...ijkl,...ijkl->l", dout_dcoeff_b2, u_grad_out)
+                grad_coeff_a1 = _contract_at_dim(dout_dcoeff_a1[None], u_grad_out, -4)[0]
+                grad_coeff_a2 = _contract_at_dim(dout_dcoeff_a2[None], u_grad_out, -3)[0]
+                grad_coeff_b1 = _contract_at_dim(dout_dcoeff_b1[None], u_grad_out, -2)[0]
+                grad_coeff_b2 = _contract_at_dim(dout_dcoeff_b2[None], u_grad_out, -1)[0]
                 # grad_coeff_all = grad_coeff_a1 + grad_coeff_a2 + grad_coeff_b1 + grad_coeff_b2
 
                 # scatter to the coefficients
@@ -562,10 +567,10 @@ class _Int4cFunction(torch.autograd.Function):
 
                 # (nu_ao)
                 # negative because the exponent is negative alpha * (r-ra)^2
-                grad_alpha_a1 = -torch.einsum("...ijkl,...ijkl->i", dout_dalphas[0], u_grad_out)
-                grad_alpha_a2 = -torch.einsum("...ijkl,...ijkl->j", dout_dalphas[1], u_grad_out)
-                grad_alpha_b1 = -torch.einsum("...ijkl,...ijkl->k", dout_dalphas[2], u_grad_out)
-                grad_alpha_b2 = -torch.einsum("...ijkl,...ijkl->l", dout_dalphas[3], u_grad_out)
+                grad_alpha_a1 = -_contract_at_dim(dout_dalphas[0][None], u_grad_out, -4)[0]
+                grad_alpha_a2 = -_contract_at_dim(dout_dalphas[1][None], u_grad_out, -3)[0]
+                grad_alpha_b1 = -_contract_at_dim(dout_dalphas[2][None], u_grad_out, -2)[0]
+                grad_alpha_b2 = -_contract_at_dim(dout_dalphas[3][None], u_grad_out, -1)[0]
                 # grad_alpha_all = (grad_alpha_a1 + grad_alpha_a2 + grad_alpha_b1 + grad_alpha_b2)
 
                 # scatter the grad
@@ -588,11 +593,12 @@ class _cintoptHandler(ctypes.c_void_p):
             pass
 
 class Intor(object):
-    def __init__(self, int_nmgr: IntorNameManager, wrappers: List[LibcintWrapper]):
+    def __init__(self, int_nmgr: IntorNameManager, wrappers: List[LibcintWrapper],
+                 rinv_pos: Optional[torch.Tensor] = None):
+        # rinv_pos: (ndim,) the centre of the rinv integrals
         assert len(wrappers) > 0
         wrapper0 = wrappers[0]
         self.int_type = int_nmgr.int_type
-        self.atm, self.bas, self.env = wrapper0.atm_bas_env
         self.wrapper0 = wrapper0
         self.int_nmgr = int_nmgr
         self.wrapper_uniqueness = _get_uniqueness([id(w) for w in wrappers])
@@ -600,7 +606,18 @@ class Intor(object):
         # get the operator
         opname = int_nmgr.get_intgl_name(wrapper0.spherical)
         self.op = getattr(CINT(), opname)
-        self.optimizer = _get_intgl_optimizer(opname, self.atm, self.bas, self.env)
+        if rinv_pos is None:
+            self.atm_bas_env_ptrs = wrapper0.atm_bas_env_ptrs
+            self.optimizer = _get_cached_intgl_optimizer(opname, wrapper0)
+        else:
+            # set the centre in a private copy of env instead of the wrapper's
+            # env, so the rinv integrals with different centres can be
+            # calculated concurrently
+            atm, bas, env = wrapper0.atm_bas_env
+            self.env = env.copy()
+            self.env[PTR_RINV_ORIG: PTR_RINV_ORIG + NDIM] = rinv_pos.detach().cpu().numpy()
+            self.atm_bas_env_ptrs = (*wrapper0.atm_bas_env_ptrs[:-1], np2ctypes(self.env))
+            self.optimizer = _get_intgl_optimizer(opname, atm, bas, self.env)
 
         # prepare the output
         comp_shape = int_nmgr.get_intgl_components_shape()
@@ -625,18 +642,22 @@ class Intor(object):
         # performing 2-centre integrals with libcint
         drv = CGTO().GTOint2c
         outshape = self.outshape
+        ao_loc = self.wrapper0.full_shell_to_aoloc
+        ao_loc_ptr = self.wrapper0.full_shell_to_aoloc_ptr
+
+        def calc(shls_slice: Tuple[int, ...], out: np.ndarray) -> None:
+            drv(self.op,
+                out.ctypes.data_as(ctypes.c_void_p),
+                ctypes.c_int(self.ncomp),
+                ctypes.c_int(0),  # do not assume hermitian
+                (ctypes.c_int * len(shls_slice))(*shls_slice),
+                ao_loc_ptr,
+                self.optimizer,
+                *self.atm_bas_env_ptrs)
+
+        # the output is in (..., j, i) order, so it is split over j
         out = np.empty((*outshape[:-2], outshape[-1], outshape[-2]), dtype=np.float64)
-        drv(self.op,
-            out.ctypes.data_as(ctypes.c_void_p),
-            ctypes.c_int(self.ncomp),
-            ctypes.c_int(0),  # do not assume hermitian
-            (ctypes.c_int * len(self.shls_slice))(*self.shls_slice),
-            np2ctypes(self.wrapper0.full_shell_to_aoloc),
-            self.optimizer,
-            np2ctypes(self.atm), int2ctypes(self.atm.shape[0]),
-            np2ctypes(self.bas), int2ctypes(self.bas.shape[0]),
-            np2ctypes(self.env))
-
+        _calc_split_shells(calc, out, self.shls_slice, ao_loc, isplit=1, axis=-2)
         out = np.swapaxes(out, -2, -1)
         # TODO: check if we need to do the lines below for 3rd order grad and higher
         # if out.ndim > 2:
@@ -650,17 +671,21 @@ class Intor(object):
         # TODO: create optimizer without the 3rd index like in
         # https://github.com/pyscf/pyscf/blob/e833b9a4fd5fb24a061721e5807e92c44bb66d06/pyscf/gto/moleintor.py#L538
         outsh = self.outshape
+        ao_loc = self.wrapper0.full_shell_to_aoloc
+        ao_loc_ptr = self.wrapper0.full_shell_to_aoloc_ptr
+
+        def calc(shls_slice: Tuple[int, ...], out: np.ndarray) -> None:
+            drv(self.op, fill,
+                out.ctypes.data_as(ctypes.c_void_p),
+                int2ctypes(self.ncomp),
+                (ctypes.c_int * len(shls_slice))(*shls_slice),
+                ao_loc_ptr,
+                self.optimizer,
+                *self.atm_bas_env_ptrs)
+
+        # the output is in (..., k, j, i) order, so it is split over k
         out = np.empty((*outsh[:-3], outsh[-1], outsh[-2], outsh[-3]), dtype=np.float64)
-        drv(self.op, fill,
-            out.ctypes.data_as(ctypes.c_void_p),
-            int2ctypes(self.ncomp),
-            (ctypes.c_int * len(self.shls_slice))(*self.shls_slice),
-            np2ctypes(self.wrapper0.full_shell_to_aoloc),
-            self.optimizer,
-            np2ctypes(self.atm), int2ctypes(self.atm.shape[0]),
-            np2ctypes(self.bas), int2ctypes(self.bas.shape[0]),
-            np2ctypes(self.env))
-
+        _calc_split_shells(calc, out, self.shls_slice, ao_loc, isplit=2, axis=-3)
         out = np.swapaxes(out, -3, -1)
         return self._to_tensor(out)
 
@@ -669,20 +694,28 @@ class Intor(object):
         symm = self.int_nmgr.get_intgl_symmetry(self.wrapper_uniqueness)
         outshape = symm.get_reduced_shape(self.outshape)
 
-        out = np.empty(outshape, dtype=np.float64)
-
         drv = CGTO().GTOnr2e_fill_drv
         fill = getattr(CGTO(), "GTOnr2e_fill_%s" % symm.code)
         prescreen = ctypes.POINTER(ctypes.c_void_p)()
-        drv(self.op, fill, prescreen,
-            out.ctypes.data_as(ctypes.c_void_p),
-            ctypes.c_int(self.ncomp),
-            (ctypes.c_int * 8)(*self.shls_slice),
-            np2ctypes(self.wrapper0.full_shell_to_aoloc),
-            self.optimizer,
-            np2ctypes(self.atm), int2ctypes(self.atm.shape[0]),
-            np2ctypes(self.bas), int2ctypes(self.bas.shape[0]),
-            np2ctypes(self.env))
+        ao_loc = self.wrapper0.full_shell_to_aoloc
+        ao_loc_ptr = self.wrapper0.full_shell_to_aoloc_ptr
+
+        def calc(shls_slice: Tuple[int, ...], out: np.ndarray) -> None:
+            drv(self.op, fill, prescreen,
+                out.ctypes.data_as(ctypes.c_void_p),
+                ctypes.c_int(self.ncomp),
+                (ctypes.c_int * 8)(*shls_slice),
+                ao_loc_ptr,
+                self.optimizer,
+                *self.atm_bas_env_ptrs)
+
+        out = np.empty(outshape, dtype=np.float64)
+        if symm.code == "s1":
+            # without symmetry, the blocks of the first index are independent,
+            # so they can be calculated in parallel
+            _calc_split_shells(calc, out, self.shls_slice, ao_loc, isplit=0, axis=-4)
+        else:
+            calc(self.shls_slice, out)
 
         out = symm.reconstruct_array(out, self.outshape)
         return self._to_tensor(out)
@@ -692,6 +725,45 @@ class Intor(object):
         return torch.as_tensor(out, dtype=self.wrapper0.dtype,
                                device=self.wrapper0.device)
 
+# minimum number of elements of an integral output per thread in _calc_split_shells
+_MIN_SPLIT_SIZE = 32768
+
+def _calc_split_shells(calc: Callable[[Tuple[int, ...], np.ndarray], None],
+                       out: np.ndarray, shls_slice: Tuple[int, ...], ao_loc: np.ndarray,
+                       isplit: int, axis: int) -> None:
+    # split the shells of the isplit-th wrapper in shls_slice into chunks with
+    # similar number of atomic orbitals, and fill the output `out` by
+    # evaluating calc(shls_slice, out_chunk) of every chunk in parallel threads
+    # (libcint calls release the GIL)
+    # small outputs are not split, as the threads cost more than they save
+    # the ao dimension of the split wrapper is at the given axis of `out`
+    sh0, sh1 = shls_slice[2 * isplit: 2 * isplit + 2]
+    nchunks = min(config.NTHREADS, sh1 - sh0, out.size // _MIN_SPLIT_SIZE)
+    if nchunks <= 1:
+        calc(shls_slice, out)
+        return
+
+    ao_bounds = np.linspace(ao_loc[sh0], ao_loc[sh1], nchunks + 1)
+    sh_bounds = np.unique(np.searchsorted(ao_loc[sh0: sh1 + 1], ao_bounds) + sh0)
+    axis = axis % out.ndim
+
+    def calc_chunk(chunk_shells: Tuple[int, int]) -> None:
+        csh0, csh1 = chunk_shells
+        chunk_slice = (*shls_slice[:2 * isplit], csh0, csh1, *shls_slice[2 * isplit + 2:])
+        idx = (slice(None),) * axis + (slice(ao_loc[csh0] - ao_loc[sh0], ao_loc[csh1] - ao_loc[sh0]),)
+        out_chunk = out[idx]
+        # libcint writes a contiguous block, which is a view of out if the
+        # split axis is the slowest one (i.e. there is only one component)
+        if out_chunk.flags.c_contiguous:
+            calc(chunk_slice, out_chunk)
+        else:
+            tmp = np.empty(out_chunk.shape, dtype=out.dtype)
+            calc(chunk_slice, tmp)
+            out_chunk[...] = tmp
+
+    chunks = [(int(a), int(b)) for (a, b) in zip(sh_bounds[:-1], sh_bounds[1:])]
+    thread_map(calc_chunk, chunks)
+
 def _get_intgl_optimizer(opname: str,
                          atm: np.ndarray, bas: np.ndarray, env: np.ndarray)\
                          -> ctypes.c_void_p:
@@ -707,6 +779,14 @@ def _get_intgl_optimizer(opname: str,
     opt = ctypes.cast(cintopt, _cintoptHandler)
     return opt
 
+def _get_cached_intgl_optimizer(opname: str, wrapper: LibcintWrapper) -> ctypes.c_void_p:
+    # get the optimizer of the integrals, reusing the one built previously for
+    # the same triplets (e.g. in the derivative integrals of the backward pass)
+    cache = wrapper.optimizer_cache
+    if opname not in cache:
+        cache[opname] = _get_intgl_optimizer(opname, *wrapper.atm_bas_env)
+    return cache[opname]
+
 ############### name derivation manager functions ###############
 def _get_integrals(int_nmgrs: List[IntorNameManager],
                    wrappers: List[LibcintWrapper],
@@ -780,9 +860,14 @@ def _get_integrals(int_nmgrs: List[IntorNameManager],
 
 def _transpose(a: torch.Tensor, axes: List[Tuple[int, int]]) -> torch.Tensor:
     # perform the transpose of two axes for tensor a
-    for axis2 in axes:
-        a = a.transpose(*axis2)
-    return a
+    # the swaps are composed into one permutation to make only one view
+    identity = list(range(a.ndim))
+    perm = list(identity)
+    for i, j in axes:
+        perm[i], perm[j] = perm[j], perm[i]
+    if perm == identity:
+        return a
+    return a.permute(*perm)
 
 def _swap_list(a: List, swaps: List[Tuple[int, int]]) -> List:
     # swap the elements according to the swaps input
@@ -808,6 +893,23 @@ def _gather_at_dims(inp: torch.Tensor, mapidxs: List[torch.Tensor],
         out = torch.gather(out, dim=dim, index=map2)
     return out
 
+def _contract_at_dim(a: torch.Tensor, b: torch.Tensor, dim: int) -> torch.Tensor:
+    # multiply a and b and sum over all the dimensions except the first
+    # dimension of a and the dimension dim of b
+    # a: (nbatch, *b.shape)
+    # b: (..., n, ...)
+    # out: (nbatch, n)
+    # the other dimensions are flattened (as views) into the ones before and
+    # after dim, so the reduction does not permute the large tensors
+    dim = dim % b.ndim
+    n = b.shape[dim]
+    a2 = a.reshape(a.shape[0], -1, n, reduce(operator.mul, b.shape[dim + 1:], 1))
+    b2 = b.reshape(-1, *a2.shape[2:])  # (nbefore, n, nafter)
+    if b2.shape[0] == 1:
+        # (n, nbatch, nafter) @ (n, nafter, 1) -> (n, nbatch, 1)
+        return torch.bmm(a2[:, 0].transpose(0, 1), b2[0].unsqueeze(-1))[..., 0].transpose(0, 1)
+    return (a2 * b2).sum(dim=(1, 3))
+
 def _get_uniqueness(a: List) -> List[int]:
     # get the uniqueness pattern from the list, e.g. _get_uniqueness([1, 1, 2, 3, 2])
     # will return [0, 0, 1, 2, 1]
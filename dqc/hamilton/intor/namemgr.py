@@ -1,7 +1,7 @@
 from __future__ import annotations
 from collections import defaultdict
+from functools import lru_cache
 from typing import Optional, Tuple, List, Sequence
-import re
 import copy
 from dqc.hamilton.intor.symmetry import BaseSymmetry, S1Symmetry, S4Symmetry
 
@@ -35,6 +35,7 @@ class IntorNameManager(object):
         self._int_type = int_type
         self._shortname = shortname
         self._rawop, self._ops = self.split_name(int_type, shortname)
+        self._ops_key = tuple(tuple(op) for op in self._ops)  # hashable version of _ops
         self._nbasis = len(self._ops)
         self._imid = (self._nbasis + 1) // 2  # middle index (where the rawops should be)
 
@@ -127,8 +128,20 @@ class IntorNameManager(object):
         # returns None if it cannot.
         # returns the list of two dims if it can for the transpose-path of `self`
         # to get the same result as `other`
+        if self._ops_key == other._ops_key:
+            return []  # identical basis operators need no transpose
+        path = self._get_transpose_path(self._ops_key, other._ops_key)
+        return None if path is None else list(path)
 
-        nbasis = self._nbasis
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _get_transpose_path(cls, ops: Tuple[Tuple[str, ...], ...],
+                            other_ops: Tuple[Tuple[str, ...], ...]) \
+            -> Optional[Tuple[Tuple[int, int], ...]]:
+        # the search of get_transpose_path_to from the basis operators, cached
+        # because it is called for every derivative integral in the backward
+
+        nbasis = len(ops)
         # get the basis transpose paths
         if nbasis == 2:
             transpose_paths: List[List[Tuple[int, int]]] = [
@@ -152,63 +165,80 @@ class IntorNameManager(object):
                 [(-1, -3), (-2, -4), (-3, -4)],
             ]
         else:
-            raise self._nbasis_error(nbasis)
+            raise cls._nbasis_error(nbasis)
 
-        def _swap(p: List[List[str]], path: List[Tuple[int, int]]) -> List[List[str]]:
+        def _swap(p: Tuple[Tuple[str, ...], ...], path: List[Tuple[int, int]]) \
+                -> List[Tuple[str, ...]]:
             # swap the pattern according to the given transpose path
-            r = p[:]  # make a copy
+            r = list(p)  # make a copy
             for i0, i1 in path:
                 r[i0], r[i1] = r[i1], r[i0]
             return r
 
         # try all the transpose path until gets a match
         for transpose_path in transpose_paths:
-            if _swap(self._ops, transpose_path) == other._ops:
-                return transpose_path
+            if _swap(ops, transpose_path) == list(other_ops):
+                return tuple(transpose_path)
         return None
 
     def get_comp_permute_path(self, transpose_path: List[Tuple[int, int]]) -> List[int]:
         # get the component permute path given the basis transpose path
-        flat_ops: List[str] = sum(self._ops, [])
-        n_ip = flat_ops.count("ip")
+        return list(self._get_comp_permute_path(self._rawop, self._ops_key,
+                                                tuple(transpose_path)))
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _get_comp_permute_path(cls, rawop: str, ops: Tuple[Tuple[str, ...], ...],
+                               transpose_path: Tuple[Tuple[int, int], ...]) -> Tuple[int, ...]:
+        # the calculation of get_comp_permute_path, cached as it only depends on
+        # the names and it is called for every transposed derivative integral
+        nbasis = len(ops)
+        imid = (nbasis + 1) // 2
 
         # get the positions of the axes
         dim_pos = []
         ioffset = 0
-        for i, ops in enumerate(self._ops):
-            if i == self._imid:
-                naxes = self.rawop_ndim[self._rawop]
+        for i, bops in enumerate(ops):
+            if i == imid:
+                naxes = cls.rawop_ndim[rawop]
                 dim_pos.append(list(range(ioffset, ioffset + naxes)))
                 ioffset += naxes
-            naxes = sum([self.op_ndim[op] for op in ops])
+            naxes = sum([cls.op_ndim[op] for op in bops])
             dim_pos.append(list(range(ioffset, ioffset + naxes)))
             ioffset += naxes
 
         # add the bases' axes (assuming each basis only occupy one axes)
-        for i in range(self._nbasis):
+        for i in range(nbasis):
             dim_pos.append([ioffset])
             ioffset += 1
 
         # swap the axes
         for t0, t1 in transpose_path:
-            s0 = t0 + self._nbasis
-            s1 = t1 + self._nbasis
-            s0 += 1 if s0 >= self._imid else 0
-            s1 += 1 if s1 >= self._imid else 0
+            s0 = t0 + nbasis
+            s1 = t1 + nbasis
+            s0 += 1 if s0 >= imid else 0
+            s1 += 1 if s1 >= imid else 0
             dim_pos[s0], dim_pos[s1] = dim_pos[s1], dim_pos[s0]
 
         # flatten the list to get the permutation path
         dim_pos_flat: List[int] = sum(dim_pos, [])
-        return dim_pos_flat
+        return tuple(dim_pos_flat)
 
     @classmethod
     def split_name(cls, int_type: str, shortname: str) -> Tuple[str, List[List[str]]]:
         # split the shortname into operator per basis and return the raw shortname as well
         # the first returned element is the raw shortname (i.e. the middle operator)
         # while the second returned element is the list of basis-operator shortname
+        rawsname, ops = cls._split_name(int_type, shortname)
+        return rawsname, [list(op) for op in ops]
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _split_name(cls, int_type: str, shortname: str) -> Tuple[str, Tuple[Tuple[str, ...], ...]]:
+        # the parsing of split_name, cached because only a handful of integral
+        # names are used, but they are parsed in every forward and backward call
 
         deriv_ops = cls.ops_name
-        deriv_pattern = re.compile("(" + ("|".join(deriv_ops)) + ")")
 
         # get the raw shortname (i.e. shortname without derivative operators)
         rawsname = shortname
@@ -234,10 +264,26 @@ class IntorNameManager(object):
         else:
             raise cls._nbasis_error(nbasis)
 
-        ops = [re.findall(deriv_pattern, op_str) for op_str in ops_str]
+        ops = tuple(cls._scan_ops(op_str) for op_str in ops_str)
         assert len(ops) == nbasis
         return rawsname, ops
 
+    @classmethod
+    def _scan_ops(cls, op_str: str) -> Tuple[str, ...]:
+        # find the basis operators in the string from left to right, skipping
+        # characters that do not start any operator name
+        ops: List[str] = []
+        i = 0
+        while i < len(op_str):
+            for op in cls.ops_name:
+                if op_str.startswith(op, i):
+                    ops.append(op)
+                    i += len(op)
+                    break
+            else:
+                i += 1
+        return tuple(ops)
+
     @classmethod
     def join_name(cls, int_type: str, rawsname: str, ops: List[List[str]]) -> str:
         # get the shortname given rawsname and list of basis ops
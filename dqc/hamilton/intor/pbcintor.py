@@ -468,7 +468,7 @@ def _get_default_kpts(kpts: Optional[torch.Tensor], dtype: torch.dtype,
     if kpts is None:
         kpts1 = torch.zeros((1, NDIM), dtype=dtype, device=device)
     else:
-        kpts1 = kpts.to(dtype).to(device)
+        kpts1 = kpts.to(dtype=dtype, device=device)
         assert kpts1.ndim == 2
         assert kpts1.shape[-1] == NDIM
     return kpts1
@@ -481,7 +481,7 @@ def _get_default_kpts_ij(kpts_ij: Optional[torch.Tensor], dtype: torch.dtype,
     if kpts_ij is None:
         kpts1 = torch.zeros((1, 2, NDIM), dtype=dtype, device=device)
     else:
-        kpts1 = kpts_ij.to(dtype).to(device)
+        kpts1 = kpts_ij.to(dtype=dtype, device=device)
         assert kpts1.ndim == 3
         assert kpts1.shape[-1] == NDIM
         assert kpts1.shape[-2] == 2
@@ -15,7 +15,9 @@ from pyscf.pbc.dft import numint as pbc_numint
 dtype = torch.float64
 cdtype = torch.complex128
 
-@pytest.fixture(params=[
+# the systems are only read by the tests, so build them (and their grids) once
+# per module instead of once per test
+@pytest.fixture(scope="module", params=[
     {"basis_ortho": False, "ao_parameterizer": "qc"},
     {"basis_ortho": True, "ao_parameterizer": "matexp"},
 ])
@@ -31,7 +33,7 @@ def system1(request):
     hamilton.setup_grid(m.get_grid())
     return m
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def pbc_h1():
     # get the hamiltonian for pbc system
     # setup the environment
@@ -178,6 +180,37 @@ def test_cgto_ao_params(system1):
     assert torch.allclose(dm, dm2)
     assert torch.allclose(penalty, torch.zeros_like(penalty))
 
+def test_cgto_elrep_df_singular_j2c():
+    # check that the density fitting with a linearly dependent auxiliary basis
+    # (i.e. singular j2c) uses the pseudo-inverse and still gives the same
+    # electron repulsion as the independent auxiliary basis
+    import dqc.hamilton.intor as intor
+    from dqc.df.dfmol import DFMol
+
+    poss = torch.tensor([[0.0, 0.0, 0.8], [0.0, 0.0, -0.8]], dtype=dtype)
+    atombases = [AtomCGTOBasis(atomz=1, bases=loadbasis("1:3-21G", dtype=dtype), pos=pos) for pos in poss]
+    wrapper = intor.LibcintWrapper(atombases, spherical=True)
+    auxbases = [AtomCGTOBasis(atomz=1, bases=loadbasis("1:def2-sv(p)-jkfit", dtype=dtype), pos=pos)
+                for pos in poss]
+
+    nao = wrapper.nao()
+    dm = torch.randn((nao, nao), dtype=dtype)
+    dm = (dm + dm.transpose(-2, -1)) * 0.5
+
+    df = DFMol(DensityFitInfo(method="coulomb", auxbases=auxbases), wrapper).build()
+    df_dup = DFMol(DensityFitInfo(method="coulomb", auxbases=auxbases + auxbases), wrapper).build()
+    assert df._j2c_is_pd
+    assert not df_dup._j2c_is_pd
+
+    elrep = df.get_elrep(dm).fullmatrix()
+    elrep_dup = df_dup.get_elrep(dm).fullmatrix()
+    assert torch.all(torch.isfinite(elrep_dup))
+    assert torch.allclose(elrep_dup, elrep, rtol=1e-6, atol=1e-6)
+
+    # density fitting approximates the exact electron repulsion
+    elrep_exact = torch.einsum("ijkl,kl->ij", intor.elrep(wrapper), dm)
+    assert torch.allclose(elrep_dup, elrep_exact, rtol=0, atol=1e-2)
+
 def test_pbc_cgto_nuclattr(pbc_h1):
     import numpy as np
     # nuc = pbc_h1.get_nuc()
@@ -198,6 +198,60 @@ def test_integral_with_subset(intc_type):
     else:
         raise RuntimeError("Unknown integral type: %s" % intc_type)
 
+def _check_threaded_integrals(fcns, monkeypatch):
+    # check that the integrals calculated with the shells split across several
+    # threads are exactly the same as the ones calculated serially
+    from dqc.hamilton.intor import molintor
+    from dqc.utils.config import config
+
+    mats = [fcn() for fcn in fcns]
+    monkeypatch.setattr(config, "NTHREADS", 4)
+    monkeypatch.setattr(molintor, "_MIN_SPLIT_SIZE", 1)
+    for fcn, mat in zip(fcns, mats):
+        assert torch.equal(fcn(), mat)
+
+@pytest.mark.parametrize(
+    "shortname",
+    # the derivatives have several components, so the split output chunks are
+    # not contiguous
+    ["ar12b", "ipar12b", "ar12bip"]
+)
+def test_integral_threads_int4c(shortname, monkeypatch):
+    # check the 4-centre integrals with the shells split across threads
+    env = get_wrapper(get_atom_env(dtype), spherical=True)
+    env1 = env[1:]
+    fcns = [
+        lambda: intor.int2e(shortname, env),
+        lambda: intor.int2e(shortname, env, env1, env, env1),
+        lambda: intor.int2e(shortname, env1, env, env1, env),
+    ]
+    _check_threaded_integrals(fcns, monkeypatch)
+
+@pytest.mark.parametrize(
+    "int_type,shortname",
+    [("int1e", "ovlp"), ("int1e", "ipkin"), ("int1e", "kinip"), ("int1e", "r0"),
+     ("int2c2e", "r12"), ("int2c2e", "r12ip"),
+     ("int3c2e", "ar12"), ("int3c2e", "aipr12"), ("int3c2e", "ar12ip")]
+)
+def test_integral_threads_int2c_int3c(int_type, shortname, monkeypatch):
+    # check the 2- and 3-centre integrals with the shells split across threads
+    env = get_wrapper(get_atom_env(dtype), spherical=True)
+    env1 = env[1:]
+    if int_type == "int3c2e":
+        fcns = [
+            lambda: intor.int3c2e(shortname, env),
+            lambda: intor.int3c2e(shortname, env, env1, env1),
+            lambda: intor.int3c2e(shortname, env1, env, env),
+        ]
+    else:
+        fcn = intor.int1e if int_type == "int1e" else intor.int2c2e
+        fcns = [
+            lambda: fcn(shortname, env),
+            lambda: fcn(shortname, env, env1),
+            lambda: fcn(shortname, env1, env),
+        ]
+    _check_threaded_integrals(fcns, monkeypatch)
+
 def test_nuc_integral_frac_atomz():
     # test the nuclear integral with fractional atomz
     atomenv1 = get_atom_env(dtype, atomz=1)
@@ -546,6 +600,38 @@ def test_eval_gto_transpose(eval_type):
     assert torch.allclose(ao_value, ao_valueT.transpose(-2, -1))
     assert torch.allclose(ao_value1, ao_value1T.transpose(-2, -1))
 
+@pytest.mark.parametrize(
+    "eval_type,ngrid,nblk",
+    list(itertools.product(
+        ["", "grad", "lapl"],
+        [5, 128, 3 * 128 + 5],
+        [64, 2],
+    ))
+)
+def test_eval_gto_screening(eval_type, ngrid, nblk, monkeypatch):
+    # check that screening the shells in every block of grid points gives the
+    # same values as evaluating all the shells everywhere, including grids
+    # smaller than a block and a partial last chunk of blocks
+    from dqc.hamilton.intor import gtoeval
+
+    atomenv = get_atom_env(dtype)
+    wrapper = get_wrapper(atomenv, spherical=True)
+    wrapper1 = wrapper[1:]
+    # the far end of the grid is far enough from the atoms to be screened
+    z = torch.linspace(-3, 40, ngrid, dtype=dtype)
+    zeros = torch.zeros(ngrid, dtype=dtype)
+    rgrid = torch.stack((zeros + 0.1, zeros, z), dim=-1)
+    fcn = {"": intor.eval_gto, "grad": intor.eval_gradgto, "lapl": intor.eval_laplgto}[eval_type]
+
+    monkeypatch.setattr(gtoeval, "_NON0TAB_NBLK", nblk)
+    ao_values = [fcn(w, rgrid) for w in (wrapper, wrapper1)]
+
+    make_non0tab = gtoeval._make_non0tab
+    monkeypatch.setattr(gtoeval, "_make_non0tab", lambda w, coords: np.ones_like(make_non0tab(w, coords)))
+    for w, ao_value in zip((wrapper, wrapper1), ao_values):
+        ao_value_all = fcn(w, rgrid)
+        assert torch.allclose(ao_value, ao_value_all, rtol=0, atol=1e-12)
+
 @pytest.mark.parametrize(
     "eval_type,partial,to_transpose",
     list(itertools.product(
@@ -581,8 +667,8 @@ def test_eval_gto_grad_pos(eval_type, partial, to_transpose):
             raise RuntimeError("Unknown name: %s" % name)
 
     # evals gradcheck
-    torch.autograd.gradcheck(evalgto, (rgrid, eval_type, *poss))
-    torch.autograd.gradgradcheck(evalgto, (rgrid, eval_type, *poss))
+    torch.autograd.gradcheck(evalgto, (rgrid, eval_type, *poss), fast_mode=True)
+    torch.autograd.gradgradcheck(evalgto, (rgrid, eval_type, *poss), fast_mode=True)
 
 @pytest.mark.parametrize(
     "eval_type,partial,to_transpose",
@@ -620,8 +706,8 @@ def test_eval_gto_grad_basis(eval_type, partial, to_transpose):
             raise RuntimeError("Unknown name: %s" % name)
 
     # evals gradcheck
-    torch.autograd.gradcheck(evalgto, (alphas, coeffs))
-    torch.autograd.gradgradcheck(evalgto, (alphas, coeffs))
+    torch.autograd.gradcheck(evalgto, (alphas, coeffs), fast_mode=True)
+    torch.autograd.gradgradcheck(evalgto, (alphas, coeffs), fast_mode=True)
 
 ################ pbc intor ################
 @pytest.mark.parametrize(
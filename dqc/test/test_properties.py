@@ -452,7 +452,7 @@ def test_optimal_geometry(h2o_qc):
         [0.0, 0.0, 0.214],
         [0.0, 1.475, -0.863],
         [0.0, -1.475, -0.863],
-    ], dtype=dtype).requires_grad_()
+    ], dtype=dtype)
    
     # use bond length to assess optimal geometry as they are rotation invariant
     def bond_length(h2o):
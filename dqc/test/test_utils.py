@@ -1,7 +1,8 @@
+import threading
 import torch
 import dqc.utils
 from dqc.utils.config import config
-from dqc.utils.misc import logger
+from dqc.utils.misc import logger, thread_map
 from dqc.test.utils import assert_fail
 
 def test_converter_length():
@@ -39,3 +40,41 @@ def test_logger(capsys):
 
     # restore the verbosity level to 0
     config.VERBOSE = 0
+
+def test_thread_map():
+    # test if thread_map keeps the order, propagates the grad mode, and runs the
+    # nested calls serially in the worker thread
+    nthreads0 = config.NTHREADS
+    config.NTHREADS = 4
+    try:
+        def fcn(i):
+            inner_threads = thread_map(lambda j: threading.get_ident(), range(3))
+            return i, torch.is_grad_enabled(), set(inner_threads) == {threading.get_ident()}
+
+        res = thread_map(fcn, range(10))
+        assert [r[0] for r in res] == list(range(10))
+        assert all(r[1] for r in res)
+        assert all(r[2] for r in res)
+
+        with torch.no_grad():
+            res = thread_map(fcn, range(10))
+        assert not any(r[1] for r in res)
+    finally:
+        config.NTHREADS = nthreads0
+
+def test_occnumber():
+    # test the occupation numbers of integer, fractional, and tensor electrons
+    from dqc.utils.safeops import occnumber
+    dtype = torch.float64
+
+    assert torch.equal(occnumber(3, dtype=dtype), torch.tensor([1.0, 1.0, 1.0], dtype=dtype))
+    assert torch.equal(occnumber(2, n=4, dtype=dtype), torch.tensor([1.0, 1.0, 0.0, 0.0], dtype=dtype))
+    assert torch.equal(occnumber(0, n=1, dtype=dtype), torch.tensor([0.0], dtype=dtype))
+    assert torch.allclose(occnumber(2.25, n=4, dtype=dtype), torch.tensor([1.0, 1.0, 0.25, 0.0], dtype=dtype))
+
+    # the gradient only flows to the fractional occupation
+    a = torch.tensor(1.5, dtype=dtype, requires_grad=True)
+    occ = occnumber(a, n=3, dtype=dtype)
+    assert torch.allclose(occ, torch.tensor([1.0, 0.5, 0.0], dtype=dtype))
+    grad_a, = torch.autograd.grad((occ * torch.tensor([1.0, 2.0, 3.0], dtype=dtype)).sum(), a)
+    assert torch.allclose(grad_a, torch.tensor(2.0, dtype=dtype))
@@ -6,6 +6,8 @@ from dqc.api.getxc import get_libxc
 from dqc.xc.custom_xc import CustomXC
 from dqc.utils.datastruct import ValGrad, SpinParam
 from dqc.utils.safeops import safepow, safenorm
+from dqc.utils.config import config
+import dqc.xc.libxc_wrapper as libxc_wrapper
 
 def test_libxc_lda_gradcheck():
     name = "lda_c_pw"
@@ -140,6 +142,146 @@ def test_libxc_mgga_gradcheck():
     torch.autograd.gradgradcheck(get_edens_pol, param_pol)
     torch.autograd.gradgradcheck(get_vxc_pol, param_pol)
 
+def test_libxc_recompute(monkeypatch):
+    # check if recomputing the libxc derivatives in the backward gives the
+    # same gradients as keeping them from the forward
+    xc = get_libxc("gga_x_pbe")
+
+    # count the libxc calls to make sure the backward does call libxc again
+    ncalls = [0]
+    compute = xc.libxc_pol.compute
+
+    def counted_compute(*args, **kwargs):
+        ncalls[0] += 1
+        return compute(*args, **kwargs)
+
+    monkeypatch.setattr(xc.libxc_pol, "compute", counted_compute)
+
+    torch.manual_seed(123)
+    n = 10
+    rho_u = torch.rand((n,), dtype=torch.float64).requires_grad_()
+    rho_d = torch.rand((n,), dtype=torch.float64).requires_grad_()
+    grad_u = torch.rand((3, n), dtype=torch.float64).requires_grad_()
+    grad_d = torch.rand((3, n), dtype=torch.float64).requires_grad_()
+    params = (rho_u, rho_d, grad_u, grad_d)
+
+    def get_grads():
+        densinfo = SpinParam(u=ValGrad(value=rho_u, grad=grad_u),
+                             d=ValGrad(value=rho_d, grad=grad_d))
+        edens = xc.get_edensityxc(densinfo)
+        return torch.autograd.grad(edens.sum(), params)
+
+    grads = get_grads()
+    ncalls_keep = ncalls[0]
+    init_value = config.LIBXC_RECOMPUTE
+    try:
+        config.LIBXC_RECOMPUTE = True
+        grads_recomp = get_grads()
+    finally:
+        config.LIBXC_RECOMPUTE = init_value
+    ncalls_recomp = ncalls[0] - ncalls_keep
+
+    assert ncalls_keep == 1
+    assert ncalls_recomp == 2
+    for (g, g_recomp) in zip(grads, grads_recomp):
+        assert torch.allclose(g, g_recomp)
+
+def test_libxc_next_derivs_double_backward(monkeypatch):
+    # check if the derivatives kept from the forward are also used in a
+    # backward with create_graph, giving the same second derivatives as
+    # recomputing them with libxc
+    xc = get_libxc("gga_x_pbe")
+
+    ncalls = [0]
+    compute = xc.libxc_pol.compute
+
+    def counted_compute(*args, **kwargs):
+        ncalls[0] += 1
+        return compute(*args, **kwargs)
+
+    monkeypatch.setattr(xc.libxc_pol, "compute", counted_compute)
+
+    torch.manual_seed(123)
+    n = 10
+    rho_u = torch.rand((n,), dtype=torch.float64).requires_grad_()
+    rho_d = torch.rand((n,), dtype=torch.float64).requires_grad_()
+    grad_u = torch.rand((3, n), dtype=torch.float64).requires_grad_()
+    grad_d = torch.rand((3, n), dtype=torch.float64).requires_grad_()
+    params = (rho_u, rho_d, grad_u, grad_d)
+
+    def get_grad2s():
+        densinfo = SpinParam(u=ValGrad(value=rho_u, grad=grad_u),
+                             d=ValGrad(value=rho_d, grad=grad_d))
+        edens = xc.get_edensityxc(densinfo)
+        grads = torch.autograd.grad(edens.sum(), params, create_graph=True)
+        loss = torch.zeros((), dtype=torch.float64)
+        for grad in grads:
+            loss = loss + (grad * grad).sum()
+        return torch.autograd.grad(loss, params)
+
+    ncalls[0] = 0
+    grad2s = get_grad2s()
+    ncalls_keep = ncalls[0]
+    monkeypatch.setattr(config, "LIBXC_RECOMPUTE", True)
+    ncalls[0] = 0
+    grad2s_recomp = get_grad2s()
+    ncalls_recomp = ncalls[0]
+
+    # forward and the second derivatives (+ the first ones if recomputing)
+    assert ncalls_keep == 2
+    assert ncalls_recomp == 3
+    for (g, g_recomp) in zip(grad2s, grad2s_recomp):
+        assert torch.allclose(g, g_recomp)
+
+def _get_libxc_vals_grads(name: str, polarized: bool, n: int = 20):
+    # returns the energy density, the potential, and the gradients of both
+    # w.r.t. the density inputs of the given libxc functional
+    xc = get_libxc(name)
+
+    torch.manual_seed(123)
+    nspin = 2 if polarized else 1
+    rhos = [torch.rand((n,), dtype=torch.float64).requires_grad_() for _ in range(nspin)]
+    grads = [torch.rand((3, n), dtype=torch.float64).requires_grad_() for _ in range(nspin)]
+    lapls = [torch.rand((n,), dtype=torch.float64).requires_grad_() for _ in range(nspin)]
+    kins = [(torch.rand((n,), dtype=torch.float64) +
+             (torch.norm(grad, dim=-2) ** 2 / (8 * rho)).detach()).requires_grad_()
+            for (rho, grad) in zip(rhos, grads)]
+    valgrads = [ValGrad(value=rho, grad=grad, lapl=lapl, kin=kin)
+                for (rho, grad, lapl, kin) in zip(rhos, grads, lapls, kins)]
+    densinfo: Union[ValGrad, SpinParam[ValGrad]] = \
+        SpinParam(u=valgrads[0], d=valgrads[1]) if polarized else valgrads[0]
+    params = [*rhos, *grads, *lapls, *kins]
+
+    edens = xc.get_edensityxc(densinfo)
+    potinfo = xc.get_vxc(densinfo)
+    if isinstance(potinfo, SpinParam):
+        potinfos = [potinfo.u, potinfo.d]
+    else:
+        potinfos = [potinfo]
+    vals = [edens] + [v for pot in potinfos for v in (pot.value, pot.grad) if v is not None]
+    loss = torch.zeros((), dtype=torch.float64)
+    for val in vals:
+        loss = loss + val.sum()
+    dvals = torch.autograd.grad(loss, params, allow_unused=True)
+    return vals + [dval for dval in dvals if dval is not None]
+
+@pytest.mark.parametrize("threaded", [False, True])
+@pytest.mark.parametrize("polarized", [False, True])
+@pytest.mark.parametrize("name", ["lda_x", "gga_x_pbe", "mgga_x_scan"])
+def test_libxc_chunks(name, polarized, threaded, monkeypatch):
+    # check if calculating libxc in chunks of points (optionally in threads)
+    # gives the same values and gradients as calculating all the points at once
+    res = _get_libxc_vals_grads(name, polarized)
+    monkeypatch.setattr(libxc_wrapper, "_LIBXC_CHUNK", 7)
+    if threaded:
+        monkeypatch.setattr(config, "LIBXC_THREADS", True)
+        monkeypatch.setattr(config, "NTHREADS", 4)
+    res_chunks = _get_libxc_vals_grads(name, polarized)
+
+    assert len(res) == len(res_chunks)
+    for (val, val_chunks) in zip(res, res_chunks):
+        assert torch.allclose(val, val_chunks)
+
 def test_libxc_lda_value():
     # check if the value is consistent
     xc = get_libxc("lda_x")
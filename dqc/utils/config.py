@@ -1,3 +1,4 @@
+import os
 from dataclasses import dataclass
 
 __all__ = ["config"]
@@ -8,6 +9,20 @@ class _Config(object):
     THRESHOLD_MEMORY: int = 10 * 1024 ** 3  # in B
     # The memory for splitting big tensors into chunks
     CHUNK_MEMORY: int = 16 * 1024 ** 2  # in B
+    # Number of threads of the parallel loops (e.g. the independent blocks of
+    # the libcint integrals), 1 means serial
+    NTHREADS: int = 1
+    # Check the inputs of the safe operations (e.g. the base of safepow), costs
+    # an extra pass over the tensor and a device sync, so it can be turned off
+    # with DQC_SAFE_CHECK=0 (or "false")
+    SAFEOPS_CHECK: bool = os.environ.get("DQC_SAFE_CHECK", "1").lower() not in ("", "0", "false")
+    # Recompute the libxc derivatives needed in the backward instead of
+    # computing them in the forward and keeping them until the backward,
+    # lowering the peak memory at the cost of an extra libxc call
+    LIBXC_RECOMPUTE: bool = False
+    # Compute the chunks of large grids in libxc with NTHREADS threads sharing
+    # one libxc functional object
+    LIBXC_THREADS: bool = False
 
     VERBOSE: int = 0  # verbosity level
 
@@ -46,13 +46,16 @@ class CGTOBasis:
 
         coeffs = self.coeffs
 
+        # overlap integrals between the primitives, its diagonal is the
+        # self-overlap of the individual gaussians
+        ee = self.alphas.unsqueeze(-1) + self.alphas.unsqueeze(-2)  # (ngauss, ngauss)
+        ee = gaussian_int(2 * self.angmom + 2, ee)
+
         # normalize to have individual gaussian integral to be 1 (if coeff is 1)
-        coeffs = coeffs / torch.sqrt(gaussian_int(2 * self.angmom + 2, 2 * self.alphas))
+        coeffs = coeffs / torch.sqrt(torch.diagonal(ee, dim1=-2, dim2=-1))
 
         # normalize the coefficients in the basis (because some basis such as
         # def2-svp-jkfit is not normalized to have 1 in overlap)
-        ee = self.alphas.unsqueeze(-1) + self.alphas.unsqueeze(-2)  # (ngauss, ngauss)
-        ee = gaussian_int(2 * self.angmom + 2, ee)
         s1 = 1 / torch.sqrt(torch.einsum("a,ab,b", coeffs, ee, coeffs))
         coeffs = coeffs * s1
 
@@ -1,5 +1,7 @@
-from typing import Callable, overload, TypeVar, Any, Mapping, Dict
+from typing import Callable, overload, TypeVar, Any, Mapping, Dict, List, Optional, Sequence
 import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import copy
 import scipy.special
@@ -42,6 +44,45 @@ def get_option(name: str, s: K, options: Mapping[K, T]) -> T:
     else:
         raise ValueError(f"Unknown {name}: {s}. The available options are: {str(list(options.keys()))}")
 
+# the thread pool shared by thread_map, (re)created with config.NTHREADS workers
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_thread_pool_size = 0
+_thread_pool_lock = threading.Lock()
+# marks the worker threads while they run a task of thread_map
+_thread_local = threading.local()
+
+def thread_map(fcn: Callable[[T], K], items: Sequence[T]) -> List[K]:
+    # returns [fcn(item) for item in items] with the calls distributed in the
+    # shared pool of config.NTHREADS threads (only useful if fcn releases the
+    # GIL, e.g. calling libcint)
+    # the calls are serial with only 1 thread or inside another thread_map's
+    # task, so the nested loops do not multiply the threads
+    global _thread_pool, _thread_pool_size
+    nthreads = config.NTHREADS
+    if nthreads <= 1 or len(items) <= 1 or getattr(_thread_local, "in_task", False):
+        return [fcn(item) for item in items]
+
+    with _thread_pool_lock:
+        if _thread_pool is None or _thread_pool_size != nthreads:
+            if _thread_pool is not None:
+                _thread_pool.shutdown(wait=False)
+            _thread_pool = ThreadPoolExecutor(max_workers=nthreads)
+            _thread_pool_size = nthreads
+        pool = _thread_pool
+
+    # grad mode is thread-local, so it is propagated to the worker threads
+    grad_enabled = torch.is_grad_enabled()
+
+    def task(item: T) -> K:
+        _thread_local.in_task = True
+        try:
+            with torch.set_grad_enabled(grad_enabled):
+                return fcn(item)
+        finally:
+            _thread_local.in_task = False
+
+    return list(pool.map(task, items))
+
 @overload
 def gaussian_int(n: int, alpha: float) -> float:
     ...
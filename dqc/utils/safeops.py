@@ -2,20 +2,22 @@ import math
 import torch
 from typing import Union, Optional, Tuple
 from dqc.utils.datastruct import ZType
+from dqc.utils.config import config
 
 eps = 1e-12
 
 ########################## safe operations ##########################
 
 def safepow(a: torch.Tensor, p: torch.Tensor, eps: float = 1e-12) -> torch.Tensor:
-    if torch.any(a < 0):
+    if config.SAFEOPS_CHECK and torch.any(a < 0):
         raise RuntimeError("safepow only works for positive base")
-    base = torch.sqrt(a * a + eps * eps)  # soft clip
+    base = torch.hypot(a, a.new_tensor(eps))  # soft clip, sqrt(a^2 + eps^2)
     return base ** p
 
 def safenorm(a: torch.Tensor, dim: int, eps: float = 1e-15) -> torch.Tensor:
     # calculate the 2-norm safely
-    return torch.sqrt(torch.sum(a * a + eps * eps, dim=dim))
+    # the eps^2 of every element is added after the reduction
+    return torch.sqrt(a.square().sum(dim=dim) + eps * eps * a.shape[dim])
 
 ########################## occupation number gradients ##########################
 def occnumber(a: ZType,
@@ -37,7 +39,8 @@ def occnumber(a: ZType,
 
     if isinstance(a, torch.Tensor):
         assert a.numel() == 1
-        floor_a, ceil_a = _get_floor_and_ceil(a.item())
+        a_val = a.item()  # read once, it is reused when constructing the tensor
+        floor_a, ceil_a = _get_floor_and_ceil(a_val)
     else:  # int or float
         floor_a, ceil_a = _get_floor_and_ceil(a)
 
@@ -49,32 +52,32 @@ def occnumber(a: ZType,
         assert nlength >= ceil_a, "The length of occupation number must be at least %d" % ceil_a
 
     if isinstance(a, torch.Tensor):
-        res = _OccNumber.apply(a, floor_a, ceil_a, nlength, dtype, device)
+        res = _OccNumber.apply(a, a_val, floor_a, ceil_a, nlength, dtype, device)
     else:
-        res = _construct_occ_number(a, floor_a, ceil_a, nlength, dtype=dtype, device=device)
+        res = _construct_occ_number(a, nlength, dtype=dtype, device=device)
     return res
 
-def _construct_occ_number(a: float, floor_a: int, ceil_a: int, nlength: int,
+def _construct_occ_number(a: float, nlength: int,
                           dtype: torch.dtype, device: torch.device) -> torch.Tensor:
-    res = torch.zeros(nlength, dtype=dtype, device=device)
-    res[:floor_a] = 1
-    if ceil_a > floor_a:
-        res[ceil_a - 1] = a - floor_a
-    return res
+    # the i-th occupation is (a - i) clipped to [0, 1], i.e. 1 below floor_a,
+    # the fractional part at ceil_a - 1, and 0 after that
+    # (calculated in double, so the fractional part is exact before the cast)
+    idxs = torch.arange(nlength, dtype=torch.float64, device=device)
+    return torch.clamp(a - idxs, min=0.0, max=1.0).to(dtype)
 
 class _OccNumber(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, a: torch.Tensor,  # type: ignore
+    def forward(ctx, a: torch.Tensor, a_val: float,  # type: ignore
                 floor_a: int, ceil_a: int, nlength: int,
                 dtype: torch.dtype, device: torch.device) -> torch.Tensor:
-        res = _construct_occ_number(float(a.item()), floor_a, ceil_a, nlength, dtype=dtype, device=device)
+        res = _construct_occ_number(float(a_val), nlength, dtype=dtype, device=device)
         ctx.ceil_a = ceil_a
         return res
 
     @staticmethod
     def backward(ctx, grad_res: torch.Tensor):  # type: ignore
         grad_a = grad_res[ctx.ceil_a - 1]
-        return (grad_a,) + (None,) * 5
+        return (grad_a,) + (None,) * 6
 
 ########################## other tensor ops ##########################
 def safe_cdist(a: torch.Tensor, b: torch.Tensor, add_diag_eps: bool = False,
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Optional, Dict, Callable
 import torch
 
@@ -170,7 +171,10 @@ def _get_converter_value(converter: Dict[str, float], unit: UnitType) -> float:
         raise ValueError(f"Unknown unit: {unit}. Available units are: {avail_units}")
     return converter[unit]
 
+@lru_cache(maxsize=None)
 def _preproc_unit(unit: UnitType):
+    # normalized (lower case, no whitespace) unit name, cached as only a few
+    # distinct unit strings are ever used
     if unit is None:
         return unit
     else:
@@ -1,8 +1,10 @@
 from __future__ import annotations
-from typing import Mapping, Tuple, Optional, Union, Iterator, List
+from typing import Mapping, Tuple, Optional, Iterator, List, Dict
 import torch
 import numpy as np
 import warnings
+from dqc.utils.config import config
+from dqc.utils.misc import thread_map
 try:
     import pylibxc
 except (ImportError, ModuleNotFoundError) as e:
@@ -27,18 +29,21 @@ class CalcLDALibXCUnpol(torch.autograd.Function):
         inp = {
             "rho": rho.detach().numpy(),
         }
-        res = _get_libxc_res(inp, deriv, libxcfcn, family=1, polarized=False)[0]
+        res_tup, ctx.next_derivs = _get_libxc_res(inp, deriv, libxcfcn, family=1, polarized=False,
+                                                  with_next=any(ctx.needs_input_grad),
+                                                  dtype=rho.dtype)
+        res = res_tup[0]
 
-        ctx.save_for_backward(rho, res)
+        ctx.save_for_backward(rho)
         ctx.deriv = deriv
         ctx.libxcfcn = libxcfcn
         return (res,)
 
     @staticmethod
     def backward(ctx, *grad_res: torch.Tensor) -> Tuple[Optional[torch.Tensor], ...]:  # type: ignore
-        rho, res = ctx.saved_tensors
+        rho, = ctx.saved_tensors
 
-        dres_drho = CalcLDALibXCUnpol.apply(rho, ctx.deriv + 1, ctx.libxcfcn)[0]
+        dres_drho = _get_next_derivs(ctx, CalcLDALibXCUnpol, rho)[0]
         grad_rho = dres_drho * grad_res[0]
         return (grad_rho, None, None)
 
@@ -55,9 +60,12 @@ class CalcLDALibXCPol(torch.autograd.Function):
         inp = {
             "rho": _pack_input(rho_u, rho_d),
         }
-        res = _get_libxc_res(inp, deriv, libxcfcn, family=1, polarized=True)[0]
+        res_tup, ctx.next_derivs = _get_libxc_res(inp, deriv, libxcfcn, family=1, polarized=True,
+                                                  with_next=any(ctx.needs_input_grad),
+                                                  dtype=rho_u.dtype)
+        res = res_tup[0]
 
-        ctx.save_for_backward(rho_u, rho_d, res)
+        ctx.save_for_backward(rho_u, rho_d)
         ctx.deriv = deriv
         ctx.libxcfcn = libxcfcn
         return (res,)
@@ -66,28 +74,15 @@ class CalcLDALibXCPol(torch.autograd.Function):
     def backward(ctx,  # type: ignore
                  *grad_res: torch.Tensor) -> \
             Tuple[Optional[torch.Tensor], ...]:  # type: ignore
-        inps = ctx.saved_tensors[:2]
-        res = ctx.saved_tensors[2:]
+        inps = ctx.saved_tensors
         deriv = ctx.deriv
         libxcfcn = ctx.libxcfcn
 
-        derivs = CalcLDALibXCPol.apply(*inps, deriv + 1, libxcfcn)
-
-        # generated by `_generate_spin_list(deriv, ["rho"], [2])`
-        if deriv == 0:
-            deriv_idxs = [[0], [0]]
-            spin_idxs: List[List[Tuple[int, ...]]] = [[(0,)], [(1,)]]
-        elif deriv == 1:
-            deriv_idxs = [[0], [0]]
-            spin_idxs = [[(0, 1)], [(1, 2)]]
-        elif deriv == 2:
-            deriv_idxs = [[0], [0]]
-            spin_idxs = [[(0, 1, 2)], [(1, 2, 3)]]
-        elif deriv == 3:
-            deriv_idxs = [[0], [0]]
-            spin_idxs = [[(0, 1, 2, 3)], [(1, 2, 3, 4)]]
-        else:
+        derivs = _get_next_derivs(ctx, CalcLDALibXCPol, *inps)
+
+        if deriv not in _LDA_POL_IDXS:
             raise RuntimeError(f"Unimplemented derivative for deriv == {deriv} for polarized LDA")
+        deriv_idxs, spin_idxs = _LDA_POL_IDXS[deriv]
 
         grad_inps = _get_grad_inps(grad_res, inps, derivs, ctx.needs_input_grad,
                                    deriv_idxs, spin_idxs)
@@ -103,13 +98,15 @@ class CalcGGALibXCUnpol(torch.autograd.Function):
         # Every element in the tuple is a tensor with shape (ninps)
 
         inp = {
-            "rho": rho,
-            "sigma": sigma,
+            "rho": rho.detach().numpy(),
+            "sigma": sigma.detach().numpy(),
         }
         # for gga, res is a tuple
-        res = _get_libxc_res(inp, deriv, libxcfcn, family=2, polarized=False)
+        res, ctx.next_derivs = _get_libxc_res(inp, deriv, libxcfcn, family=2, polarized=False,
+                                              with_next=any(ctx.needs_input_grad),
+                                              dtype=rho.dtype)
 
-        ctx.save_for_backward(rho, sigma, *res)
+        ctx.save_for_backward(rho, sigma)
         ctx.deriv = deriv
         ctx.libxcfcn = libxcfcn
         return (*res,)
@@ -117,25 +114,15 @@ class CalcGGALibXCUnpol(torch.autograd.Function):
     @staticmethod
     def backward(ctx, *grad_res: torch.Tensor) -> \
             Tuple[Optional[torch.Tensor], ...]:  # type: ignore
-        inps = ctx.saved_tensors[:2]
-        res = ctx.saved_tensors[2:]
+        inps = ctx.saved_tensors
         deriv = ctx.deriv
         libxcfcn = ctx.libxcfcn
 
-        derivs = CalcGGALibXCUnpol.apply(*inps, deriv + 1, libxcfcn)
-
-        # generated by _generate_pair_deriv_idxs(deriv, ["rho", "sigma"])
-        # see _get_grad_inps for explanation about deriv_idxs
-        if deriv == 0:
-            deriv_idxs = [[0], [1]]
-        elif deriv == 1:
-            deriv_idxs = [[0, 1], [1, 2]]
-        elif deriv == 2:
-            deriv_idxs = [[0, 1, 2], [1, 2, 3]]
-        elif deriv == 3:
-            deriv_idxs = [[0, 1, 2, 3], [1, 2, 3, 4]]
-        else:
+        derivs = _get_next_derivs(ctx, CalcGGALibXCUnpol, *inps)
+
+        if deriv not in _GGA_UNPOL_IDXS:
             raise RuntimeError("Cannot handle GGA deriv %d" % deriv)
+        deriv_idxs = _GGA_UNPOL_IDXS[deriv]
 
         grad_inps = _get_grad_inps(grad_res, inps, derivs, ctx.needs_input_grad, deriv_idxs)
         return (*grad_inps, None, None)
@@ -156,9 +143,11 @@ class CalcGGALibXCPol(torch.autograd.Function):
             "rho": _pack_input(rho_u, rho_d),
             "sigma": _pack_input(sigma_uu, sigma_ud, sigma_dd),
         }
-        res = _get_libxc_res(inp, deriv, libxcfcn, family=2, polarized=True)
+        res, ctx.next_derivs = _get_libxc_res(inp, deriv, libxcfcn, family=2, polarized=True,
+                                              with_next=any(ctx.needs_input_grad),
+                                              dtype=rho_u.dtype)
 
-        ctx.save_for_backward(rho_u, rho_d, sigma_uu, sigma_ud, sigma_dd, *res)
+        ctx.save_for_backward(rho_u, rho_d, sigma_uu, sigma_ud, sigma_dd)
         ctx.deriv = deriv
         ctx.libxcfcn = libxcfcn
         return (*res,)
@@ -166,53 +155,15 @@ class CalcGGALibXCPol(torch.autograd.Function):
     @staticmethod
     def backward(ctx, *grad_res: torch.Tensor) -> \
             Tuple[Optional[torch.Tensor], ...]:  # type: ignore
-        inps = ctx.saved_tensors[:5]
-        res = ctx.saved_tensors[5:]
+        inps = ctx.saved_tensors
         deriv = ctx.deriv
         libxcfcn = ctx.libxcfcn
 
-        derivs = CalcGGALibXCPol.apply(*inps, deriv + 1, libxcfcn)
-
-        # generated by `_generate_spin_list(deriv, ["rho", "sigma"], [2, 3])`
-        if deriv == 0:
-            deriv_idxs = [[0], [0], [1], [1], [1]]
-            spin_idxs: List[List[Tuple[int, ...]]] = [[(0,)],
-                                                      [(1,)],
-                                                      [(0,)],
-                                                      [(1,)],
-                                                      [(2,)]]
-        elif deriv == 1:
-            deriv_idxs = [[0, 1], [0, 1], [1, 2], [1, 2], [1, 2]]
-            spin_idxs = [[(0, 1), (0, 1, 2)],
-                         [(1, 2), (3, 4, 5)],
-                         [(0, 3), (0, 1, 2)],
-                         [(1, 4), (1, 3, 4)],
-                         [(2, 5), (2, 4, 5)]]
-        elif deriv == 2:
-            deriv_idxs = [[0, 1, 2], [0, 1, 2], [1, 2, 3], [1, 2, 3], [1, 2, 3]]
-            spin_idxs = [[(0, 1, 2), (0, 1, 2, 3, 4, 5), (0, 1, 2, 3, 4, 5)],
-                         [(1, 2, 3), (3, 4, 5, 6, 7, 8), (6, 7, 8, 9, 10, 11)],
-                         [(0, 3, 6), (0, 1, 2, 6, 7, 8), (0, 1, 2, 3, 4, 5)],
-                         [(1, 4, 7), (1, 3, 4, 7, 9, 10), (1, 3, 4, 6, 7, 8)],
-                         [(2, 5, 8), (2, 4, 5, 8, 10, 11), (2, 4, 5, 7, 8, 9)]]
-        elif deriv == 3:
-            deriv_idxs = [[0, 1, 2, 3], [0, 1, 2, 3], [1, 2, 3, 4], [1, 2, 3, 4], [1, 2, 3, 4]]
-            spin_idxs = [[(0, 1, 2, 3), (0, 1, 2, 3, 4, 5, 6, 7, 8),
-                          (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11), (0, 1, 2, 3, 4, 5, 6, 7, 8, 9)],
-                         [(1, 2, 3, 4), (3, 4, 5, 6, 7, 8, 9, 10, 11),
-                          (6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17),
-                          (10, 11, 12, 13, 14, 15, 16, 17, 18, 19)],
-                         [(0, 3, 6, 9), (0, 1, 2, 6, 7, 8, 12, 13, 14),
-                          (0, 1, 2, 3, 4, 5, 10, 11, 12, 13, 14, 15),
-                          (0, 1, 2, 3, 4, 5, 6, 7, 8, 9)],
-                         [(1, 4, 7, 10), (1, 3, 4, 7, 9, 10, 13, 15, 16),
-                          (1, 3, 4, 6, 7, 8, 11, 13, 14, 16, 17, 18),
-                          (1, 3, 4, 6, 7, 8, 10, 11, 12, 13)],
-                         [(2, 5, 8, 11), (2, 4, 5, 8, 10, 11, 14, 16, 17),
-                          (2, 4, 5, 7, 8, 9, 12, 14, 15, 17, 18, 19),
-                          (2, 4, 5, 7, 8, 9, 11, 12, 13, 14)]]
-        else:
+        derivs = _get_next_derivs(ctx, CalcGGALibXCPol, *inps)
+
+        if deriv not in _GGA_POL_IDXS:
             raise RuntimeError(f"Unimplemented derivative for deriv == {deriv} for polarized GGA")
+        deriv_idxs, spin_idxs = _GGA_POL_IDXS[deriv]
 
         grad_inps = _get_grad_inps(grad_res, inps, derivs, ctx.needs_input_grad,
                                    deriv_idxs, spin_idxs)
@@ -229,15 +180,17 @@ class CalcMGGALibXCUnpol(torch.autograd.Function):
         # Every element in the tuple is a tensor with shape (ninps)
 
         inp = {
-            "rho": rho,
-            "sigma": sigma,
-            "lapl": lapl,
-            "tau": kin,
+            "rho": rho.detach().numpy(),
+            "sigma": sigma.detach().numpy(),
+            "lapl": lapl.detach().numpy(),
+            "tau": kin.detach().numpy(),
         }
         # res is a tuple
-        res = _get_libxc_res(inp, deriv, libxcfcn, family=4, polarized=False)
+        res, ctx.next_derivs = _get_libxc_res(inp, deriv, libxcfcn, family=4, polarized=False,
+                                              with_next=any(ctx.needs_input_grad),
+                                              dtype=rho.dtype)
 
-        ctx.save_for_backward(rho, sigma, lapl, kin, *res)
+        ctx.save_for_backward(rho, sigma, lapl, kin)
         ctx.deriv = deriv
         ctx.libxcfcn = libxcfcn
         return (*res,)
@@ -245,33 +198,15 @@ class CalcMGGALibXCUnpol(torch.autograd.Function):
     @staticmethod
     def backward(ctx, *grad_res: torch.Tensor) -> \
             Tuple[Optional[torch.Tensor], ...]:  # type: ignore
-        inps = ctx.saved_tensors[:4]
-        res = ctx.saved_tensors[4:]
+        inps = ctx.saved_tensors
         deriv = ctx.deriv
         libxcfcn = ctx.libxcfcn
 
-        derivs = CalcMGGALibXCUnpol.apply(*inps, deriv + 1, libxcfcn)
-
-        # generated by _generate_pair_deriv_idxs(deriv, ["rho", "sigma", "lapl", "tau"])
-        # see _get_grad_inps for explanation about deriv_idxs
-        if deriv == 0:
-            deriv_idxs = [[0], [1], [2], [3]]
-        elif deriv == 1:
-            deriv_idxs = [[0, 1, 2, 3], [1, 4, 5, 6], [2, 5, 7, 8], [3, 6, 8, 9]]
-        elif deriv == 2:
-            deriv_idxs = [[0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
-                          [1, 4, 5, 6, 10, 11, 12, 13, 14, 15],
-                          [2, 5, 7, 8, 11, 13, 14, 16, 17, 18],
-                          [3, 6, 8, 9, 12, 14, 15, 17, 18, 19]]
-        elif deriv == 3:
-            deriv_idxs = [
-                [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19],
-                [1, 4, 5, 6, 10, 11, 12, 13, 14, 15, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29],
-                [2, 5, 7, 8, 11, 13, 14, 16, 17, 18, 21, 23, 24, 26, 27, 28, 30, 31, 32, 33],
-                [3, 6, 8, 9, 12, 14, 15, 17, 18, 19, 22, 24, 25, 27, 28, 29, 31, 32, 33, 34]
-            ]
-        else:
+        derivs = _get_next_derivs(ctx, CalcMGGALibXCUnpol, *inps)
+
+        if deriv not in _MGGA_UNPOL_IDXS:
             raise RuntimeError("Cannot handle MGGA deriv %d" % deriv)
+        deriv_idxs = _MGGA_UNPOL_IDXS[deriv]
 
         grad_inps = _get_grad_inps(grad_res, inps, derivs, ctx.needs_input_grad, deriv_idxs)
         return (*grad_inps, None, None)
@@ -296,10 +231,12 @@ class CalcMGGALibXCPol(torch.autograd.Function):
             "lapl": _pack_input(lapl_u, lapl_d),
             "tau": _pack_input(kin_u, kin_d),
         }
-        res = _get_libxc_res(inp, deriv, libxcfcn, family=4, polarized=True)
+        res, ctx.next_derivs = _get_libxc_res(inp, deriv, libxcfcn, family=4, polarized=True,
+                                              with_next=any(ctx.needs_input_grad),
+                                              dtype=rho_u.dtype)
 
         ctx.save_for_backward(rho_u, rho_d, sigma_uu, sigma_ud, sigma_dd,
-                              lapl_u, lapl_d, kin_u, kin_d, *res)
+                              lapl_u, lapl_d, kin_u, kin_d)
         ctx.deriv = deriv
         ctx.libxcfcn = libxcfcn
         return (*res,)
@@ -307,95 +244,82 @@ class CalcMGGALibXCPol(torch.autograd.Function):
     @staticmethod
     def backward(ctx, *grad_res: torch.Tensor) -> \
             Tuple[Optional[torch.Tensor], ...]:  # type: ignore
-        inps = ctx.saved_tensors[:9]
-        res = ctx.saved_tensors[9:]
+        inps = ctx.saved_tensors
         deriv = ctx.deriv
         libxcfcn = ctx.libxcfcn
 
-        derivs = CalcMGGALibXCPol.apply(*inps, deriv + 1, libxcfcn)
-
-        # generated by `_generate_spin_list(deriv, ["rho", "sigma"], [2, 3])`
-        if deriv == 0:
-            deriv_idxs = [[0], [0], [1], [1], [1], [2], [2], [3], [3]]
-            spin_idxs: List[List[Tuple[int, ...]]] = [
-                [(0,)], [(1,)], [(0,)], [(1,)], [(2,)], [(0,)], [(1,)], [(0,)], [(1,)]
-            ]
-        elif deriv == 1:
-            deriv_idxs = [[0, 1, 2, 3], [0, 1, 2, 3], [1, 4, 5, 6], [1, 4, 5, 6],
-                          [1, 4, 5, 6], [2, 5, 7, 8], [2, 5, 7, 8], [3, 6, 8, 9],
-                          [3, 6, 8, 9]]
-            spin_idxs = [[(0, 1), (0, 1, 2), (0, 1), (0, 1)],
-                         [(1, 2), (3, 4, 5), (2, 3), (2, 3)],
-                         [(0, 3), (0, 1, 2), (0, 1), (0, 1)],
-                         [(1, 4), (1, 3, 4), (2, 3), (2, 3)],
-                         [(2, 5), (2, 4, 5), (4, 5), (4, 5)],
-                         [(0, 2), (0, 2, 4), (0, 1), (0, 1)],
-                         [(1, 3), (1, 3, 5), (1, 2), (2, 3)],
-                         [(0, 2), (0, 2, 4), (0, 2), (0, 1)],
-                         [(1, 3), (1, 3, 5), (1, 3), (1, 2)]]
-        elif deriv == 2:
-            deriv_idxs = [[0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
-                          [0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
-                          [1, 4, 5, 6, 10, 11, 12, 13, 14, 15],
-                          [1, 4, 5, 6, 10, 11, 12, 13, 14, 15],
-                          [1, 4, 5, 6, 10, 11, 12, 13, 14, 15],
-                          [2, 5, 7, 8, 11, 13, 14, 16, 17, 18],
-                          [2, 5, 7, 8, 11, 13, 14, 16, 17, 18],
-                          [3, 6, 8, 9, 12, 14, 15, 17, 18, 19],
-                          [3, 6, 8, 9, 12, 14, 15, 17, 18, 19]]
-            spin_idxs = [[(0, 1, 2), (0, 1, 2, 3, 4, 5), (0, 1, 2, 3), (0, 1, 2, 3),
-                          (0, 1, 2, 3, 4, 5), (0, 1, 2, 3, 4, 5), (0, 1, 2, 3, 4, 5),
-                          (0, 1, 2), (0, 1, 2, 3), (0, 1, 2)],
-                         [(1, 2, 3), (3, 4, 5, 6, 7, 8), (2, 3, 4, 5), (2, 3, 4, 5),
-                          (6, 7, 8, 9, 10, 11), (6, 7, 8, 9, 10, 11), (6, 7, 8, 9, 10, 11),
-                          (3, 4, 5), (4, 5, 6, 7), (3, 4, 5)],
-                         [(0, 3, 6), (0, 1, 2, 6, 7, 8), (0, 1, 6, 7), (0, 1, 6, 7),
-                          (0, 1, 2, 3, 4, 5), (0, 1, 2, 3, 4, 5), (0, 1, 2, 3, 4, 5),
-                          (0, 1, 2), (0, 1, 2, 3), (0, 1, 2)],
-                         [(1, 4, 7), (1, 3, 4, 7, 9, 10), (2, 3, 8, 9), (2, 3, 8, 9),
-                          (1, 3, 4, 6, 7, 8), (2, 3, 6, 7, 8, 9), (2, 3, 6, 7, 8, 9),
-                          (3, 4, 5), (4, 5, 6, 7), (3, 4, 5)],
-                         [(2, 5, 8), (2, 4, 5, 8, 10, 11), (4, 5, 10, 11), (4, 5, 10, 11),
-                          (2, 4, 5, 7, 8, 9), (4, 5, 8, 9, 10, 11), (4, 5, 8, 9, 10, 11),
-                          (6, 7, 8), (8, 9, 10, 11), (6, 7, 8)],
-                         [(0, 2, 4), (0, 2, 4, 6, 8, 10), (0, 1, 3, 4), (0, 1, 4, 5),
-                          (0, 2, 4, 6, 8, 10), (0, 1, 3, 4, 6, 7), (0, 1, 4, 5, 8, 9),
-                          (0, 1, 2), (0, 1, 2, 3), (0, 1, 2)],
-                         [(1, 3, 5), (1, 3, 5, 7, 9, 11), (1, 2, 4, 5), (2, 3, 6, 7),
-                          (1, 3, 5, 7, 9, 11), (1, 2, 4, 5, 7, 8), (2, 3, 6, 7, 10, 11),
-                          (1, 2, 3), (2, 3, 4, 5), (3, 4, 5)],
-                         [(0, 2, 4), (0, 2, 4, 6, 8, 10), (0, 2, 4, 6), (0, 1, 3, 4),
-                          (0, 2, 4, 6, 8, 10), (0, 2, 4, 6, 8, 10), (0, 1, 3, 4, 6, 7),
-                          (0, 2, 4), (0, 1, 3, 4), (0, 1, 2)],
-                         [(1, 3, 5), (1, 3, 5, 7, 9, 11), (1, 3, 5, 7), (1, 2, 4, 5),
-                          (1, 3, 5, 7, 9, 11), (1, 3, 5, 7, 9, 11), (1, 2, 4, 5, 7, 8),
-                          (1, 3, 5), (1, 2, 4, 5), (1, 2, 3)]]
-        else:
+        derivs = _get_next_derivs(ctx, CalcMGGALibXCPol, *inps)
+
+        if deriv not in _MGGA_POL_IDXS:
             raise RuntimeError(f"Unimplemented derivative for deriv == {deriv} for polarized MGGA")
+        deriv_idxs, spin_idxs = _MGGA_POL_IDXS[deriv]
 
         grad_inps = _get_grad_inps(grad_res, inps, derivs, ctx.needs_input_grad,
                                    deriv_idxs, spin_idxs)
         return (*grad_inps, None, None)
 
-def _get_libxc_res(inp: Mapping[str, Union[np.ndarray, Tuple[np.ndarray, ...], torch.Tensor, Tuple[torch.Tensor, ...]]],
+class _LibXCNextDerivs(torch.autograd.Function):
+    # returns the next derivatives calculated in the forward of fcn as if they
+    # were calculated by fcn.apply(*inps, deriv, libxcfcn), i.e. with fcn's
+    # backward, so they can be used in a backward that makes the graph for the
+    # higher order derivatives without calling libxc again
+    @staticmethod
+    def forward(ctx, *args) -> Tuple[torch.Tensor, ...]:  # type: ignore
+        # args: (*inps, fcn, deriv, libxcfcn, next_derivs), with the inputs
+        # first so the needs_input_grad in fcn's backward is of the inputs
+        inps = args[:-4]
+        ctx.fcn, ctx.deriv, ctx.libxcfcn, next_derivs = args[-4:]
+        ctx.next_derivs = None
+        ctx.save_for_backward(*inps)
+        # the outputs are new tensors, so the ones kept in the forward of fcn
+        # are not attached to this graph
+        return tuple(d.clone() for d in next_derivs)
+
+    @staticmethod
+    def backward(ctx, *grad_res: torch.Tensor) -> Tuple[Optional[torch.Tensor], ...]:  # type: ignore
+        ninps = len(ctx.saved_tensors)
+        grad_inps = ctx.fcn.backward(ctx, *grad_res)[:ninps]
+        return (*grad_inps, None, None, None, None)
+
+def _get_libxc_res(inp: Mapping[str, np.ndarray],
                    deriv: int,
                    libxcfcn: pylibxc.functional.LibXCFunctional,
-                   family: int, polarized: bool) -> Tuple[torch.Tensor, ...]:
+                   family: int, polarized: bool, with_next: bool = False,
+                   dtype: Optional[torch.dtype] = None) -> \
+        Tuple[Tuple[torch.Tensor, ...], Optional[Tuple[torch.Tensor, ...]]]:
     # deriv == 0 for energy per unit volume
     # deriv == 1 for vrho (1st derivative of energy/volume w.r.t. density)
     # deriv == 2 for v2rho2
     # deriv == 3 for v3rho3
     # deriv == 4 for v4rho4
-    do_exc, do_vxc, do_fxc, do_kxc, do_lxc = _get_dos(deriv)
-
-    res = libxcfcn.compute(
-        inp,
-        do_exc=do_exc, do_vxc=do_vxc, do_fxc=do_fxc,
-        do_kxc=do_kxc, do_lxc=do_lxc
-    )
+    # if with_next, the (deriv + 1)-th derivatives are calculated in the same
+    # libxc call and returned as the second element (to be used in the
+    # backward), otherwise the second element is None
+    # (they are not calculated if config.LIBXC_RECOMPUTE is set, so the backward
+    # recalculates them instead of keeping them in memory)
+    # the results are cast to dtype (if given) in the conversion to tensors
+    with_next = with_next and not config.LIBXC_RECOMPUTE and deriv < len(LDA_KEYS) - 1
+    dos = _get_dos(deriv)
+    if with_next:
+        dos = tuple(do or do_next for (do, do_next) in zip(dos, _get_dos(deriv + 1)))
+    do_exc, do_vxc, do_fxc, do_kxc, do_lxc = dos
+
+    try:
+        ret = _libxc_compute(
+            libxcfcn, inp,
+            do_exc=do_exc, do_vxc=do_vxc, do_fxc=do_fxc,
+            do_kxc=do_kxc, do_lxc=do_lxc
+        )
+    except ValueError:
+        # the next derivative is not available in the functional, so leave
+        # the error to the backward (if it is ever called)
+        if not with_next:
+            raise
+        return _get_libxc_res(inp, deriv, libxcfcn, family, polarized, dtype=dtype)
 
     # compile the results in a tuple with order given in the *_KEYS (e.g. LDA_KEYS)
-    res = _extract_returns(res, deriv, family)
+    res = _extract_returns(ret, deriv, family, dtype)
+    next_res = _extract_returns(ret, deriv + 1, family, dtype) if with_next else None
 
     # In libxc, "zk" is the only one returning the energy density
     # per unit volume PER UNIT PARTICLE.
@@ -404,30 +328,65 @@ def _get_libxc_res(inp: Mapping[str, Union[np.ndarray, Tuple[np.ndarray, ...], t
     if deriv == 0:
         rho = inp["rho"]
         if polarized:
-            assert isinstance(rho, np.ndarray)
-            start = np.zeros(1, dtype=rho.dtype)
-            rho = sum(_unpack_input(rho), start)  # rho[:, 0] + rho[:, 1]
-        res0 = res[0] * rho
-        res = (res0, *res[1:])
-
-    return res
+            rho = rho.sum(axis=-1)  # rho[:, 0] + rho[:, 1]
+        # res[0] is a new tensor from libxc's results, so it can be scaled in place
+        res[0].mul_(torch.as_tensor(rho, dtype=res[0].dtype))
+
+    return res, next_res
+
+# maximum number of points passed to libxc in one compute call
+_LIBXC_CHUNK = 65536
+
+def _libxc_compute(libxcfcn: pylibxc.functional.LibXCFunctional,
+                   inp: Mapping[str, np.ndarray], **dos: bool) -> Mapping[str, np.ndarray]:
+    # calls libxc's compute in chunks of points along the first axis, so the
+    # working set of every call stays cache-sized for large grids, writing
+    # each chunk's results directly into the full output arrays
+    # if config.LIBXC_THREADS is set, the chunks are computed in the shared
+    # thread pool (libxc is called through ctypes which releases the GIL)
+    npts = len(inp["rho"])
+    if npts <= _LIBXC_CHUNK:
+        return libxcfcn.compute(inp, **dos)
+
+    def compute_chunk(i0: int) -> Mapping[str, np.ndarray]:
+        inp_chunk = {key: val[i0:i0 + _LIBXC_CHUNK] for (key, val) in inp.items()}
+        return libxcfcn.compute(inp_chunk, **dos)
+
+    i0s = range(0, npts, _LIBXC_CHUNK)
+    ret_chunks = thread_map(compute_chunk, i0s) if config.LIBXC_THREADS else map(compute_chunk, i0s)
+    ret: Dict[str, np.ndarray] = {}
+    for (i0, ret_chunk) in zip(i0s, ret_chunks):
+        for (key, val) in ret_chunk.items():
+            if key not in ret:
+                ret[key] = np.empty((npts, *val.shape[1:]), dtype=val.dtype)
+            ret[key][i0:i0 + _LIBXC_CHUNK] = val
+    return ret
+
+def _get_next_derivs(ctx, fcn, *inps: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+    # returns the (deriv + 1)-th derivatives for the backward of fcn
+    # the ones calculated in the forward are used if available, attached to
+    # the graph for the higher order derivatives if the backward needs to be
+    # differentiable, otherwise they are calculated with fcn
+    if ctx.next_derivs is None:
+        return fcn.apply(*inps, ctx.deriv + 1, ctx.libxcfcn)
+    if not torch.is_grad_enabled():
+        return ctx.next_derivs
+    return _LibXCNextDerivs.apply(*inps, fcn, ctx.deriv + 1, ctx.libxcfcn, ctx.next_derivs)
 
 def _pack_input(*vals: torch.Tensor) -> np.ndarray:
     # arrange the values in a numpy array with fortran memory order
-    vals_np = np.asarray([val.detach().numpy() for val in vals])
-    return np.ascontiguousarray(vals_np.T)
+    # (i.e. (ninps, nvals) in C order), stacked directly in the final layout
+    return torch.stack([val.detach() for val in vals], dim=-1).numpy()
 
 def _unpack_input(inp: np.ndarray) -> Iterator[np.ndarray]:
     # unpack from libxc input format into tuple of inputs
-    return (a for a in inp.T)
+    return iter(inp.T)
+
+# (do_exc, do_vxc, do_fxc, do_kxc, do_lxc) for every deriv
+_DOS = tuple(tuple(i == deriv for i in range(5)) for deriv in range(5))
 
 def _get_dos(deriv: int) -> Tuple[bool, ...]:
-    do_exc = deriv == 0
-    do_vxc = deriv == 1
-    do_fxc = deriv == 2
-    do_kxc = deriv == 3
-    do_lxc = deriv == 4
-    return do_exc, do_vxc, do_fxc, do_kxc, do_lxc
+    return _DOS[deriv]
 
 # generated by [_generate_keys(i, ["rho", "sigma"]) for i in range(5)]
 # _generate_keys function is below
@@ -455,11 +414,123 @@ MGGA_KEYS = [['zk'],
               'v4sigmalapl3', 'v4sigmalapl2tau', 'v4sigmalapltau2', 'v4sigmatau3',
               'v4lapl4', 'v4lapl3tau', 'v4lapl2tau2', 'v4lapltau3', 'v4tau4']]
 
-def _extract_returns(ret: Mapping[str, np.ndarray], deriv: int, family: int) -> \
+# the indices of derivs to pair with grad_res for every input in the backward
+# (see _get_grad_inps)
+# generated by {i: _generate_spin_list(i, ["rho"], [2]) for i in range(4)}
+_LDA_POL_IDXS: Dict[int, Tuple[List[List[int]], List[List[Tuple[int, ...]]]]] = {
+    0: ([[0], [0]],
+        [[(0,)], [(1,)]]),
+    1: ([[0], [0]],
+        [[(0, 1)], [(1, 2)]]),
+    2: ([[0], [0]],
+        [[(0, 1, 2)], [(1, 2, 3)]]),
+    3: ([[0], [0]],
+        [[(0, 1, 2, 3)], [(1, 2, 3, 4)]]),
+}
+# generated by {i: _generate_pair_deriv_idxs(i, ["rho", "sigma"]) for i in range(4)}
+_GGA_UNPOL_IDXS: Dict[int, List[List[int]]] = {
+    0: [[0], [1]],
+    1: [[0, 1], [1, 2]],
+    2: [[0, 1, 2], [1, 2, 3]],
+    3: [[0, 1, 2, 3], [1, 2, 3, 4]],
+}
+# generated by {i: _generate_spin_list(i, ["rho", "sigma"], [2, 3]) for i in range(4)}
+_GGA_POL_IDXS: Dict[int, Tuple[List[List[int]], List[List[Tuple[int, ...]]]]] = {
+    0: ([[0], [0], [1], [1], [1]],
+        [[(0,)], [(1,)], [(0,)], [(1,)], [(2,)]]),
+    1: ([[0, 1], [0, 1], [1, 2], [1, 2], [1, 2]],
+        [[(0, 1), (0, 1, 2)],
+         [(1, 2), (3, 4, 5)],
+         [(0, 3), (0, 1, 2)],
+         [(1, 4), (1, 3, 4)],
+         [(2, 5), (2, 4, 5)]]),
+    2: ([[0, 1, 2], [0, 1, 2], [1, 2, 3], [1, 2, 3], [1, 2, 3]],
+        [[(0, 1, 2), (0, 1, 2, 3, 4, 5), (0, 1, 2, 3, 4, 5)],
+         [(1, 2, 3), (3, 4, 5, 6, 7, 8), (6, 7, 8, 9, 10, 11)],
+         [(0, 3, 6), (0, 1, 2, 6, 7, 8), (0, 1, 2, 3, 4, 5)],
+         [(1, 4, 7), (1, 3, 4, 7, 9, 10), (1, 3, 4, 6, 7, 8)],
+         [(2, 5, 8), (2, 4, 5, 8, 10, 11), (2, 4, 5, 7, 8, 9)]]),
+    3: ([[0, 1, 2, 3], [0, 1, 2, 3], [1, 2, 3, 4], [1, 2, 3, 4], [1, 2, 3, 4]],
+        [[(0, 1, 2, 3), (0, 1, 2, 3, 4, 5, 6, 7, 8), (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11),
+          (0, 1, 2, 3, 4, 5, 6, 7, 8, 9)],
+         [(1, 2, 3, 4), (3, 4, 5, 6, 7, 8, 9, 10, 11), (6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17),
+          (10, 11, 12, 13, 14, 15, 16, 17, 18, 19)],
+         [(0, 3, 6, 9), (0, 1, 2, 6, 7, 8, 12, 13, 14), (0, 1, 2, 3, 4, 5, 10, 11, 12, 13, 14, 15),
+          (0, 1, 2, 3, 4, 5, 6, 7, 8, 9)],
+         [(1, 4, 7, 10), (1, 3, 4, 7, 9, 10, 13, 15, 16),
+          (1, 3, 4, 6, 7, 8, 11, 13, 14, 16, 17, 18), (1, 3, 4, 6, 7, 8, 10, 11, 12, 13)],
+         [(2, 5, 8, 11), (2, 4, 5, 8, 10, 11, 14, 16, 17),
+          (2, 4, 5, 7, 8, 9, 12, 14, 15, 17, 18, 19), (2, 4, 5, 7, 8, 9, 11, 12, 13, 14)]]),
+}
+# generated by {i: _generate_pair_deriv_idxs(i, ["rho", "sigma", "lapl", "tau"]) for i in range(4)}
+_MGGA_UNPOL_IDXS: Dict[int, List[List[int]]] = {
+    0: [[0], [1], [2], [3]],
+    1: [[0, 1, 2, 3], [1, 4, 5, 6], [2, 5, 7, 8], [3, 6, 8, 9]],
+    2: [[0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
+        [1, 4, 5, 6, 10, 11, 12, 13, 14, 15],
+        [2, 5, 7, 8, 11, 13, 14, 16, 17, 18],
+        [3, 6, 8, 9, 12, 14, 15, 17, 18, 19]],
+    3: [[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19],
+        [1, 4, 5, 6, 10, 11, 12, 13, 14, 15, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29],
+        [2, 5, 7, 8, 11, 13, 14, 16, 17, 18, 21, 23, 24, 26, 27, 28, 30, 31, 32, 33],
+        [3, 6, 8, 9, 12, 14, 15, 17, 18, 19, 22, 24, 25, 27, 28, 29, 31, 32, 33, 34]],
+}
+# generated by {i: _generate_spin_list(i, ["rho", "sigma", "lapl", "tau"], [2, 3, 2, 2]) for i in range(3)}
+_MGGA_POL_IDXS: Dict[int, Tuple[List[List[int]], List[List[Tuple[int, ...]]]]] = {
+    0: ([[0], [0], [1], [1], [1], [2], [2], [3], [3]],
+        [[(0,)], [(1,)], [(0,)], [(1,)], [(2,)], [(0,)], [(1,)], [(0,)], [(1,)]]),
+    1: ([[0, 1, 2, 3],
+         [0, 1, 2, 3],
+         [1, 4, 5, 6],
+         [1, 4, 5, 6],
+         [1, 4, 5, 6],
+         [2, 5, 7, 8],
+         [2, 5, 7, 8],
+         [3, 6, 8, 9],
+         [3, 6, 8, 9]],
+        [[(0, 1), (0, 1, 2), (0, 1), (0, 1)],
+         [(1, 2), (3, 4, 5), (2, 3), (2, 3)],
+         [(0, 3), (0, 1, 2), (0, 1), (0, 1)],
+         [(1, 4), (1, 3, 4), (2, 3), (2, 3)],
+         [(2, 5), (2, 4, 5), (4, 5), (4, 5)],
+         [(0, 2), (0, 2, 4), (0, 1), (0, 1)],
+         [(1, 3), (1, 3, 5), (1, 2), (2, 3)],
+         [(0, 2), (0, 2, 4), (0, 2), (0, 1)],
+         [(1, 3), (1, 3, 5), (1, 3), (1, 2)]]),
+    2: ([[0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
+         [0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
+         [1, 4, 5, 6, 10, 11, 12, 13, 14, 15],
+         [1, 4, 5, 6, 10, 11, 12, 13, 14, 15],
+         [1, 4, 5, 6, 10, 11, 12, 13, 14, 15],
+         [2, 5, 7, 8, 11, 13, 14, 16, 17, 18],
+         [2, 5, 7, 8, 11, 13, 14, 16, 17, 18],
+         [3, 6, 8, 9, 12, 14, 15, 17, 18, 19],
+         [3, 6, 8, 9, 12, 14, 15, 17, 18, 19]],
+        [[(0, 1, 2), (0, 1, 2, 3, 4, 5), (0, 1, 2, 3), (0, 1, 2, 3), (0, 1, 2, 3, 4, 5),
+          (0, 1, 2, 3, 4, 5), (0, 1, 2, 3, 4, 5), (0, 1, 2), (0, 1, 2, 3), (0, 1, 2)],
+         [(1, 2, 3), (3, 4, 5, 6, 7, 8), (2, 3, 4, 5), (2, 3, 4, 5), (6, 7, 8, 9, 10, 11),
+          (6, 7, 8, 9, 10, 11), (6, 7, 8, 9, 10, 11), (3, 4, 5), (4, 5, 6, 7), (3, 4, 5)],
+         [(0, 3, 6), (0, 1, 2, 6, 7, 8), (0, 1, 6, 7), (0, 1, 6, 7), (0, 1, 2, 3, 4, 5),
+          (0, 1, 2, 3, 4, 5), (0, 1, 2, 3, 4, 5), (0, 1, 2), (0, 1, 2, 3), (0, 1, 2)],
+         [(1, 4, 7), (1, 3, 4, 7, 9, 10), (2, 3, 8, 9), (2, 3, 8, 9), (1, 3, 4, 6, 7, 8),
+          (2, 3, 6, 7, 8, 9), (2, 3, 6, 7, 8, 9), (3, 4, 5), (4, 5, 6, 7), (3, 4, 5)],
+         [(2, 5, 8), (2, 4, 5, 8, 10, 11), (4, 5, 10, 11), (4, 5, 10, 11), (2, 4, 5, 7, 8, 9),
+          (4, 5, 8, 9, 10, 11), (4, 5, 8, 9, 10, 11), (6, 7, 8), (8, 9, 10, 11), (6, 7, 8)],
+         [(0, 2, 4), (0, 2, 4, 6, 8, 10), (0, 1, 3, 4), (0, 1, 4, 5), (0, 2, 4, 6, 8, 10),
+          (0, 1, 3, 4, 6, 7), (0, 1, 4, 5, 8, 9), (0, 1, 2), (0, 1, 2, 3), (0, 1, 2)],
+         [(1, 3, 5), (1, 3, 5, 7, 9, 11), (1, 2, 4, 5), (2, 3, 6, 7), (1, 3, 5, 7, 9, 11),
+          (1, 2, 4, 5, 7, 8), (2, 3, 6, 7, 10, 11), (1, 2, 3), (2, 3, 4, 5), (3, 4, 5)],
+         [(0, 2, 4), (0, 2, 4, 6, 8, 10), (0, 2, 4, 6), (0, 1, 3, 4), (0, 2, 4, 6, 8, 10),
+          (0, 2, 4, 6, 8, 10), (0, 1, 3, 4, 6, 7), (0, 2, 4), (0, 1, 3, 4), (0, 1, 2)],
+         [(1, 3, 5), (1, 3, 5, 7, 9, 11), (1, 3, 5, 7), (1, 2, 4, 5), (1, 3, 5, 7, 9, 11),
+          (1, 3, 5, 7, 9, 11), (1, 2, 4, 5, 7, 8), (1, 3, 5), (1, 2, 4, 5), (1, 2, 3)]]),
+}
+
+def _extract_returns(ret: Mapping[str, np.ndarray], deriv: int, family: int,
+                     dtype: Optional[torch.dtype] = None) -> \
         Tuple[torch.Tensor, ...]:
     # compile the returns from pylibxc into a tuple of tensors with order given
     # by the keys
-    a = lambda v: torch.as_tensor(v.T)
     if family == 1:
         keys = LDA_KEYS
     elif family == 2:
@@ -468,7 +539,18 @@ def _extract_returns(ret: Mapping[str, np.ndarray], deriv: int, family: int) ->
         keys = MGGA_KEYS
     else:
         raise RuntimeError("Unknown libxc family %d" % family)
-    return tuple(a(ret[key]) for key in keys[deriv])
+    vals = [torch.as_tensor(ret[key].T) for key in keys[deriv]]
+
+    # copy the values (casting to dtype) into the rows of one contiguous
+    # (nrows, ninps) tensor, so every returned tensor is a contiguous block of
+    # rows next to the others instead of a strided view of libxc's output
+    nrows = [val.numel() // val.shape[-1] for val in vals]
+    allrows = torch.empty((sum(nrows), vals[0].shape[-1]),
+                          dtype=vals[0].dtype if dtype is None else dtype)
+    res = allrows.split(nrows, dim=0)
+    for (r, val) in zip(res, vals):
+        r.copy_(val.reshape(r.shape))
+    return tuple(r.reshape(val.shape) for (r, val) in zip(res, vals))
 
 def _get_grad_inps(grad_res: Tuple[torch.Tensor, ...],
                    inps: Tuple[torch.Tensor, ...],
@@ -479,6 +561,15 @@ def _get_grad_inps(grad_res: Tuple[torch.Tensor, ...],
     # calculate the grad_inp from grad_res and given deriv_idxs
     # each row indicates the input, while the column indicates the index in out
     # deriv_idxs[i][j] means that grad_inp[i] += grad_res[j] * derivs[deriv_idxs[i][j]]
+    # (summed over spin_idxs[i][j] rows of derivs[deriv_idxs[i][j]] for polarized case)
+
+    # put all the rows of grad_res and derivs in 2D tensors (nrows, ninps), so
+    # the sum over j for every input is done with one gather and one contraction
+    # (for the unpolarized case, each of them only has 1 row)
+    grad_res_rows = torch.cat([g.reshape(-1, g.shape[-1]) for g in grad_res], dim=0)
+    derivs_rows = torch.cat([d.reshape(-1, d.shape[-1]) for d in derivs], dim=0)
+    derivs_offsets = np.cumsum([0] + [d.numel() // d.shape[-1] for d in derivs]).tolist()
+
     grad_inps: List[Optional[torch.Tensor]] = []
     for i in range(len(deriv_idxs)):
         # if the input does not requires grad, then don't compute
@@ -486,15 +577,14 @@ def _get_grad_inps(grad_res: Tuple[torch.Tensor, ...],
             grad_inps.append(None)
             continue
 
-        grad_inp = torch.zeros_like(inps[i])
         didxs = deriv_idxs[i]
-        if spin_idxs is not None:
-            sidxs = spin_idxs[i]
-        for j in range(len(didxs)):
-            if spin_idxs is None:
-                grad_inp = grad_inp + grad_res[j] * derivs[didxs[j]]
-            else:
-                grad_inp = grad_inp + torch.sum(grad_res[j] * derivs[didxs[j]][sidxs[j], :], dim=0)
+        if spin_idxs is None:
+            rows = [derivs_offsets[didx] for didx in didxs]
+        else:
+            rows = [derivs_offsets[didx] + sidx for (didx, sidxs) in zip(didxs, spin_idxs[i])
+                    for sidx in sidxs]
+        rows_t = torch.as_tensor(rows, dtype=torch.long, device=derivs_rows.device)
+        grad_inp = torch.einsum("rn,rn->n", grad_res_rows, derivs_rows.index_select(0, rows_t))
         grad_inps.append(grad_inp)
     return tuple(grad_inps)
 
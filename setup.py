@@ -58,7 +58,7 @@ setup(
         "pylibxc2>=6.0.0",
         "dqclibs>=0.1.0",
         "xitorch>=0.3",
-        "torch>=1.8",  # ideally the nightly build
+        "torch>=1.9",  # ideally the nightly build
     ],
     classifiers=[
         "Development Status :: 3 - Alpha",